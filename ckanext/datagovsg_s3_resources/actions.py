@@ -0,0 +1,175 @@
+'''
+actions.py
+
+Contains the s3_resources_bulk_sync action and its auth function.
+'''
+import copy
+import logging
+import time
+from multiprocessing.pool import ThreadPool
+
+import ckan.model as model
+import ckan.plugins as plugins
+import ckan.plugins.toolkit as toolkit
+
+import ckanext.datagovsg_s3_resources.upload as upload
+from ckanext.datagovsg_s3_resources.settings import get_settings
+
+
+def s3_resources_bulk_sync(context, data_dict):
+    '''
+    s3_resources_bulk_sync
+
+    Uploads many resources to S3 in one call. The files are uploaded concurrently,
+    all the resources are updated in one transaction, and then every affected
+    resource zipfile and package zipfile is rebuilt exactly once.
+
+    :param resources: the resources to sync, given as resource ids, or as resource
+        dicts with an 'id' and the fields to update
+    :type resources: list
+
+    :returns: the status and timings of every resource and package
+    :rtype: dictionary
+    '''
+    logger = logging.getLogger(__name__)
+    start = time.time()
+
+    if not get_settings().is_complete:
+        logger.error("Required S3 config options missing. Please check if required config options exist.")
+        raise Exception('Required S3 config options missing')
+
+    toolkit.check_access('s3_resources_bulk_sync', context, data_dict)
+
+    # Obtain the current resources and apply the given updates
+    resources = []
+    current_resources = {}
+    for item in _get_resource_list(data_dict):
+        resource_id = item['id'] if isinstance(item, dict) else item
+        resource = toolkit.get_action('resource_show')(copy.copy(context), {'id': resource_id})
+        current_resources[resource['id']] = copy.deepcopy(resource)
+        if isinstance(item, dict):
+            resource.update(item)
+        resources.append(resource)
+
+    # Obtain every affected package once
+    packages = {}
+    for resource in resources:
+        if resource['package_id'] not in packages:
+            packages[resource['package_id']] = toolkit.get_action('package_show')(
+                copy.copy(context), {'id': resource['package_id']})
+
+    # Resources whose file is already in our bucket and did not change keep their S3 object,
+    # as in DatagovsgS3ResourcesPlugin.before_update. It is only copied if its key must change.
+    # Maps the ids of those resources to whether they must be copied.
+    metadata_only = {}
+    for resource in resources:
+        current = current_resources[resource['id']]
+        if upload.is_metadata_only_update(current, resource):
+            upload.keep_s3_object(current, resource)
+            metadata_only[resource['id']] = upload.needs_new_s3_key(copy.copy(context), resource)
+
+    # Upload the files concurrently. The threads share the S3 client of the process.
+    def sync(resource):
+        '''sync - uploads one resource, returns its result'''
+        result = {'id': resource['id'], 'name': resource.get('name', '')}
+        upload_start = time.time()
+        pkg = packages[resource['package_id']]
+        try:
+            if resource['id'] in metadata_only:
+                if metadata_only[resource['id']]:
+                    upload.upload_resource_to_s3(copy.copy(context), resource, pkg,
+                                                 keep_digests=True)
+                    result['status'] = 'copied'
+                else:
+                    result['status'] = 'unchanged'
+            elif resource.get('format') == 'API' or upload.is_blacklisted(resource):
+                result['status'] = 'skipped'
+            else:
+                upload.upload_resource_to_s3(copy.copy(context), resource, pkg)
+                result['status'] = 'uploaded'
+        except Exception as exception:
+            logger.error("Error uploading resource %s to S3 - %s" % (resource['id'], exception))
+            result['status'] = 'error'
+            result['error'] = str(exception)
+        result['upload_seconds'] = time.time() - upload_start
+        return result
+
+    pool = ThreadPool(get_settings().bulk_sync_concurrency)
+    try:
+        results = pool.map(sync, resources)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Update all the resources in one transaction, with one package_update per package.
+    # 'resource_create_or_update' makes the package plugin skip its zipfile upload,
+    # the zipfiles are uploaded once below.
+    synced = [resource for resource, result in zip(resources, results)
+              if result['status'] != 'error']
+    update_context = copy.copy(context)
+    update_context.update({'defer_commit': True, 'resource_create_or_update': True})
+    try:
+        for package_id, pkg in packages.items():
+            updates = dict((resource['id'], resource) for resource in synced
+                           if resource['package_id'] == package_id)
+            if not updates:
+                continue
+            pkg['resources'] = [updates.get(resource['id'], resource)
+                                for resource in pkg['resources']]
+            toolkit.get_action('package_update')(copy.copy(update_context), pkg)
+        model.repo.commit()
+    except Exception:
+        model.Session.rollback()
+        raise
+
+    # Rebuild each affected zipfile exactly once
+    results_by_id = dict((result['id'], result) for result in results)
+    for resource in synced:
+        # Zipfiles built on demand are built on the first download instead
+        if get_settings().resource_zip_mode == 'eager':
+            zip_start = time.time()
+            upload.upload_resource_zipfile_to_s3(copy.copy(context), resource)
+            results_by_id[resource['id']]['zip_seconds'] = time.time() - zip_start
+
+        # See DatagovsgS3ResourcesPlugin.after_update. Only new files need to be pushed.
+        if (results_by_id[resource['id']]['status'] == 'uploaded'
+                and plugins.plugin_loaded('datastore')):
+            toolkit.get_action('datapusher_submit')(None, {'resource_id': resource['id']})
+
+    package_results = []
+    for package_id in set(resource['package_id'] for resource in synced):
+        zip_start = time.time()
+        upload.upload_package_zipfile_to_s3(copy.copy(context), packages[package_id])
+        package_results.append({'id': package_id, 'zip_seconds': time.time() - zip_start})
+
+    return {
+        'resources': results,
+        'packages': package_results,
+        'total_seconds': time.time() - start,
+    }
+
+
+def s3_resources_bulk_sync_auth(context, data_dict):
+    '''s3_resources_bulk_sync_auth - the user must be allowed to update every given resource'''
+    for item in _get_resource_list(data_dict):
+        resource_id = item['id'] if isinstance(item, dict) else item
+        try:
+            toolkit.check_access('resource_update', copy.copy(context), {'id': resource_id})
+        except toolkit.NotAuthorized:
+            return {'success': False,
+                    'msg': toolkit._('User not authorized to update resource %s') % resource_id}
+    return {'success': True}
+
+
+def _get_resource_list(data_dict):
+    '''_get_resource_list - validated list of resources given to s3_resources_bulk_sync'''
+    resources = data_dict.get('resources')
+    if not isinstance(resources, list) or not resources:
+        raise toolkit.ValidationError({'resources': [toolkit._('Missing value')]})
+    for item in resources:
+        if isinstance(item, dict):
+            if not item.get('id'):
+                raise toolkit.ValidationError({'resources': [toolkit._('Resources must have an id')]})
+        elif not isinstance(item, basestring):
+            raise toolkit.ValidationError({'resources': [toolkit._('Resources must be ids or dicts')]})
+    return resources
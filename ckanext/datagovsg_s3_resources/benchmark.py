@@ -0,0 +1,354 @@
+'''Adds paster command to benchmark the extension'''
+import datetime
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import ckan.lib.cli as cli
+
+# Modules whose import time is measured by the startup benchmark
+STARTUP_MODULES = [
+    'ckanext.datagovsg_s3_resources.plugin',
+    'ckanext.datagovsg_s3_resources.package_plugin',
+    'boto3',
+]
+
+# Run in a fresh interpreter, so that nothing is imported yet.
+# CKAN itself is imported first, as every worker pays for it regardless of the extension.
+IMPORT_SCRIPT = '''
+import time
+import ckan.plugins
+import routes.mapper
+start = time.time()
+import %s
+print(time.time() - start)
+'''
+
+
+class S3Benchmark(cli.CkanCommand):
+    '''Benchmark the S3 resources extension
+
+      Usage:
+          s3_benchmark startup [runs] - measures the time taken to import the plugins
+            in a fresh interpreter and to create the S3 connection (default 5 runs)
+
+          s3_benchmark memory [size_mb] - measures the peak memory used to upload a
+            synthetic resource of size_mb MB (default 1024) and to build its resource
+            and package zipfiles. Exits with an error if the peak grows beyond
+            --max-chunks times ckan.datagovsg_s3_resources.s3_transfer_chunk_size.
+            Point ckan.datagovsg_s3_resources.s3_endpoint_url at a local S3 stand-in
+            to run it without AWS
+
+          s3_benchmark download - drives the package_download and resource_download
+            endpoints in-process with a WSGI test client, and measures requests per
+            second, p50/p99 latency and DB queries per request for the redirect path
+            and the local filestore path. Seeds an s3-benchmark dataset in the
+            configured database, so run it against a test database
+
+      Options:
+          --max-chunks N - peak memory allowed by the memory benchmark, in transfer
+            chunks (default 24)
+          --requests N - requests per endpoint made by the download benchmark (default 200)
+
+    '''
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 2
+    min_args = 1
+
+    def __init__(self, name):
+        super(S3Benchmark, self).__init__(name)
+        self.parser.add_option('--max-chunks', dest='max_chunks', type='int', default=24,
+                               help='Peak memory allowed by the memory benchmark, in transfer chunks')
+        self.parser.add_option('--requests', dest='requests', type='int', default=200,
+                               help='Requests per endpoint made by the download benchmark')
+
+    def command(self):
+        '''Runs on the s3_benchmark command'''
+        self._load_config()
+
+        if self.args[0] == 'startup':
+            runs = int(self.args[1]) if len(self.args) > 1 else 5
+            self.benchmark_startup(runs)
+        elif self.args[0] == 'memory':
+            size = int(self.args[1]) if len(self.args) > 1 else 1024
+            if not self.benchmark_memory(size * 1024 * 1024):
+                sys.exit(1)
+        elif self.args[0] == 'download':
+            self.benchmark_download(self.options.requests)
+        else:
+            print(self.usage)
+
+    def benchmark_startup(self, runs):
+        '''benchmark_startup - import time of the plugins, and creation time of the S3 connection'''
+        for module in STARTUP_MODULES:
+            timings = []
+            for _ in range(runs):
+                output = subprocess.check_output(
+                    [sys.executable, '-c', IMPORT_SCRIPT % module])
+                timings.append(float(output.strip().splitlines()[-1]))
+            print(format_timings('import ' + module, timings))
+
+        import ckanext.datagovsg_s3_resources.upload as upload
+
+        start = time.time()
+        upload.setup_s3_bucket()
+        print(format_timings('first setup_s3_bucket', [time.time() - start]))
+
+        timings = []
+        for _ in range(runs):
+            start = time.time()
+            upload.setup_s3_bucket()
+            timings.append(time.time() - start)
+        print(format_timings('cached setup_s3_bucket', timings))
+
+    def benchmark_memory(self, size):
+        '''benchmark_memory - peak memory of the upload and zipfile paths, returns False if over the limit'''
+        import ckanext.datagovsg_s3_resources.upload as upload
+        from ckanext.datagovsg_s3_resources.settings import get_settings
+
+        settings = get_settings()
+        limit = self.options.max_chunks * settings.transfer_chunk_size
+        bucket = upload.setup_s3_bucket()
+
+        # Everything is written under a fresh prefix, so no zipfile is skipped as up to date
+        prefix = 's3-benchmark-' + datetime.datetime.utcnow().strftime('%Y-%m-%dT%H-%M-%SZ')
+        source_key = prefix + '/source.csv'
+        source = {
+            'id': prefix,
+            'name': 'benchmark-resource',
+            'package_id': prefix,
+            'url': settings.url_prefix + source_key,
+            'url_type': 's3',
+        }
+        package_entries = [('benchmark-resource-%d.csv' % i, source) for i in range(4)]
+
+        print('Uploading a synthetic %d MB resource to %s' % (size // (1024 * 1024), source_key))
+        bucket.upload_fileobj(SyntheticBody(size), source_key, Config=upload.transfer_config())
+
+        # Objects in our bucket are copied on the S3 side, so the upload reads the
+        # source through a presigned URL to go through the streaming pipeline
+        http_source = dict(source, url_type='', url=bucket.meta.client.generate_presigned_url(
+            'get_object', Params={'Bucket': bucket.name, 'Key': source_key}))
+
+        scenarios = [
+            ('upload_resource_to_s3',
+             lambda: upload.upload_resource_to_s3({}, http_source, {'name': prefix})),
+            ('upload_resource_zipfile_to_s3',
+             lambda: upload.upload_zipfile_to_s3(prefix + '/resources/benchmark-resource.zip',
+                                                 'metadata.txt', 'benchmark', [('benchmark-resource.csv', source)])),
+            ('upload_package_zipfile_to_s3',
+             lambda: upload.upload_zipfile_to_s3(prefix + '/' + prefix + '.zip',
+                                                 'metadata.txt', 'benchmark', package_entries)),
+        ]
+
+        within_limit = True
+        try:
+            for name, scenario in scenarios:
+                peak = measure_peak_memory(scenario)
+                passed = peak <= limit
+                within_limit = within_limit and passed
+                print('%-60s peak %8.1f MB   limit %8.1f MB   %s' % (
+                    name, peak / 1048576.0, limit / 1048576.0, 'ok' if passed else 'FAILED'))
+        finally:
+            for obj in bucket.objects.filter(Prefix=prefix + '/'):
+                obj.delete()
+        return within_limit
+
+    def benchmark_download(self, requests):
+        '''benchmark_download - throughput, latency and DB queries of the download endpoints'''
+        import paste.fixture
+        from pylons import config
+        from sqlalchemy import event
+        import ckan.model as model
+        from ckan.config.middleware import make_app
+
+        pkg = seed_download_benchmark()
+        app = paste.fixture.TestApp(make_app(config['global_conf'], **config))
+
+        endpoints = [('package_download', '/dataset/%s/download' % pkg['name'])]
+        for rsc in pkg['resources']:
+            path = '/dataset/%s/resource/%s/download' % (pkg['name'], rsc['id'])
+            if rsc.get('url_type') == 'upload':
+                endpoints.append(('resource_download (filestore)', path))
+            else:
+                endpoints.append(('resource_download (redirect)', path))
+
+        # Count the queries sent to the database
+        queries = [0]
+        def count_query(*args, **kwargs):
+            '''count_query - called before every query'''
+            queries[0] += 1
+        event.listen(model.meta.engine, 'before_cursor_execute', count_query)
+
+        try:
+            for name, path in endpoints:
+                # Warm up caches and connections first
+                for _ in range(min(10, requests)):
+                    app.get(path, status='*')
+
+                statuses = set()
+                timings = []
+                queries[0] = 0
+                start = time.time()
+                for _ in range(requests):
+                    request_start = time.time()
+                    response = app.get(path, status='*')
+                    timings.append(time.time() - request_start)
+                    statuses.add(response.status)
+                total = time.time() - start
+
+                timings.sort()
+                print('%-35s %8.1f req/s   p50 %8.2f ms   p99 %8.2f ms   %6.1f queries/req   status %s' % (
+                    name,
+                    requests / total,
+                    timings[len(timings) // 2] * 1000,
+                    timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000,
+                    float(queries[0]) / requests,
+                    ', '.join(str(status) for status in sorted(statuses))))
+        finally:
+            event.remove(model.meta.engine, 'before_cursor_execute', count_query)
+
+
+def seed_download_benchmark():
+    '''
+    seed_download_benchmark - the s3-benchmark dataset, created if it does not exist
+
+    It has a resource in S3, and a resource on the CKAN filestore if ckan.storage_path is set.
+    The resources are created with package_create, so that the S3 upload hooks do not run.
+    '''
+    from pylons import config
+    import ckan.model as model
+    import ckan.plugins.toolkit as toolkit
+    import ckan.lib.uploader as uploader
+    from ckanext.datagovsg_s3_resources.settings import get_settings
+
+    site_user = toolkit.get_action('get_site_user')({'model': model, 'ignore_auth': True}, {})
+    context = {'model': model, 'session': model.Session,
+               'user': site_user['name'], 'ignore_auth': True}
+
+    try:
+        return toolkit.get_action('package_show')(dict(context), {'id': 's3-benchmark'})
+    except toolkit.ObjectNotFound:
+        pass
+
+    try:
+        org = toolkit.get_action('organization_show')(dict(context), {'id': 's3-benchmark'})
+    except toolkit.ObjectNotFound:
+        org = toolkit.get_action('organization_create')(dict(context), {'name': 's3-benchmark'})
+
+    resources = [{
+        'name': 'benchmark-s3',
+        'url': get_settings().url_prefix + 's3-benchmark/resources/benchmark-s3.csv',
+        'url_type': 's3',
+        'format': 'CSV',
+    }]
+    if config.get('ckan.storage_path'):
+        resources.append({
+            'name': 'benchmark-filestore',
+            'url': 'benchmark-filestore.csv',
+            'url_type': 'upload',
+            'format': 'CSV',
+        })
+
+    pkg = toolkit.get_action('package_create')(dict(context), {
+        'name': 's3-benchmark',
+        'title': 'S3 benchmark',
+        'owner_org': org['id'],
+        'resources': resources,
+    })
+
+    # Put a file on the filestore for the filestore resource
+    for rsc in pkg['resources']:
+        if rsc.get('url_type') == 'upload':
+            upload = uploader.ResourceUpload(rsc)
+            filepath = upload.get_path(rsc['id'])
+            directory = os.path.dirname(filepath)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(filepath, 'wb') as resource_file:
+                body = SyntheticBody(1024 * 1024)
+                for chunk in iter(lambda: body.read(65536), ''):
+                    resource_file.write(chunk)
+    return pkg
+
+
+class SyntheticBody(object):
+    '''
+    class SyntheticBody
+
+    File-like body of the given size, generated on the fly so that it is never held in memory
+    '''
+    LINE = 'id,name,value,description\r\n' + '1,benchmark,12345.678,%s\r\n' % ('x' * 64)
+
+    def __init__(self, size):
+        self.remaining = size
+        self.block = self.LINE * (65536 // len(self.LINE) + 1)
+
+    def read(self, size=-1):
+        '''read - next bytes of the body, as many as asked for, as s3transfer takes a short read for the end of the body'''
+        if size is None or size < 0:
+            size = len(self.block)
+        size = min(size, self.remaining)
+        self.remaining -= size
+        return (self.block * (size // len(self.block) + 1))[:size]
+
+
+def measure_peak_memory(func):
+    '''
+    measure_peak_memory - peak memory in bytes allocated while func runs
+
+    func runs in a forked child, so that the peaks of earlier runs do not hide later ones.
+    tracemalloc is used where available, otherwise the growth of the peak resident set size
+    '''
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            try:
+                import tracemalloc
+            except ImportError:
+                tracemalloc = None
+            if tracemalloc is not None:
+                tracemalloc.start()
+                func()
+                peak = tracemalloc.get_traced_memory()[1]
+            else:
+                before = current_rss()
+                func()
+                peak = max(0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - before)
+            os.write(write_fd, json.dumps({'peak': peak}))
+        except Exception as exception:
+            os.write(write_fd, json.dumps({'error': str(exception)}))
+            status = 1
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as result_file:
+        result = json.loads(result_file.read() or '{}')
+    os.waitpid(pid, 0)
+    if 'peak' not in result:
+        raise Exception('Memory benchmark failed - %s' % result.get('error', 'no result'))
+    return result['peak']
+
+
+def current_rss():
+    '''current_rss - current resident set size in bytes'''
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def format_timings(name, timings):
+    '''format_timings - one line summary of a list of timings in seconds'''
+    timings = sorted(timings)
+    return '%-60s median %8.2f ms   min %8.2f ms   max %8.2f ms' % (
+        name,
+        timings[len(timings) // 2] * 1000,
+        timings[0] * 1000,
+        timings[-1] * 1000)
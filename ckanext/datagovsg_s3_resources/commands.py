@@ -1,6 +1,8 @@
 '''Adds paster command to migrate existing CKAN resources to S3'''
 import copy
 import datetime
+import hashlib
+import json
 import logging
 
 import ckan.model as model
@@ -8,8 +10,10 @@ import ckan.lib.cli as cli
 import ckan.plugins.toolkit as toolkit
 import ckan.logic as logic
 from pylons import config
+from paste.script.command import BadCommand
 
 import ckanext.datagovsg_s3_resources.upload as upload
+from ckanext.datagovsg_s3_resources.settings import get_settings
 
 
 class MigrateToS3(cli.CkanCommand):
@@ -21,21 +25,45 @@ class MigrateToS3(cli.CkanCommand):
 
           migrate_s3 force_s3 - uploads ALL resources to S3
 
+          migrate_s3 merge_results SUMMARY_FILE [SUMMARY_FILE ...] - combines the
+            result summaries written by sharded runs
+
+      Options:
+          --shard I/N - only migrate the packages in shard I (0 <= I < N). The packages
+            are split by a stable hash of their id, so N independent runs with
+            I = 0 .. N-1 cover the catalogue exactly once
+          --output FILE - where to write the result summary. Sharded runs default to
+            migrate_s3-shard-I-of-N.json
+
     '''
     summary = __doc__.split('\n')[0]
     usage = __doc__
-    max_args = 1
+    max_args = None
     min_args = 0
 
+    def __init__(self, name):
+        super(MigrateToS3, self).__init__(name)
+        self.parser.add_option('--shard', dest='shard', default=None,
+                               help='Only migrate shard I of N, given as I/N')
+        self.parser.add_option('--output', dest='output', default=None,
+                               help='File to write the result summary to')
+
     def command(self):
         '''Runs on the migrate_s3 command'''
+        # Merging summaries does not need CKAN to be loaded
+        if len(self.args) > 0 and self.args[0] == 'merge_results':
+            self.merge_results(self.args[1:])
+            return
+
         self._load_config()
 
         self.skip_existing_s3_upload = True
 
         if len(self.args) > 0:
             if self.args[0] == 'force_s3':
-                skip_existing_s3_upload = False
+                self.skip_existing_s3_upload = False
+
+        shard = parse_shard(self.options.shard) if self.options.shard else None
 
         user = toolkit.get_action('get_site_user')({'model': model, 'ignore_auth': True}, {})
         context = {
@@ -46,6 +74,8 @@ class MigrateToS3(cli.CkanCommand):
         # pkg_crashes_w_error (list) - list of dicts with two fields: 'pkg_name' and 'error'
         # logger - logger object used to log messages
         package_names = toolkit.get_action('package_list')(context, {})
+        if shard:
+            package_names = self.filter_shard(package_names, *shard)
         self.pkg_crashes_w_error = []
         logger = logging.getLogger(__name__)
 
@@ -66,6 +96,63 @@ class MigrateToS3(cli.CkanCommand):
 
         logger.info("Package Crashes by error = \n%s", errors_dict)
 
+        output = self.options.output
+        if output is None and shard:
+            output = 'migrate_s3-shard-%d-of-%d.json' % shard
+        if output:
+            write_summary(output, {
+                'shard': self.options.shard,
+                'num_packages': len(package_names),
+                'num_failed': len(self.pkg_crashes_w_error),
+                'errors': errors_dict,
+            })
+            logger.info("Result summary written to %s", output)
+
+    def filter_shard(self, package_names, index, count):
+        '''filter_shard - keep only the packages that belong to the given shard'''
+        package_ids = dict(model.Session.query(model.Package.name, model.Package.id)
+                           .filter(model.Package.name.in_(package_names)))
+        model.Session.remove()
+        return [name for name in package_names
+                if shard_of(package_ids[name], count) == index]
+
+    def merge_results(self, filenames):
+        '''merge_results - combine the result summaries of sharded runs'''
+        logger = logging.getLogger(__name__)
+        if not filenames:
+            print(self.usage)
+            return
+
+        summaries = []
+        for filename in filenames:
+            with open(filename) as summary_file:
+                summaries.append(json.load(summary_file))
+
+        # Warn about shards that are missing from the given summaries
+        shards = [summary.get('shard') for summary in summaries if summary.get('shard')]
+        counts = set(parse_shard(shard)[1] for shard in shards)
+        if len(counts) > 1:
+            logger.warning("Summaries come from runs with different shard counts: %s", sorted(counts))
+        for count in counts:
+            missing = set(range(count)) - set(parse_shard(shard)[0] for shard in shards)
+            if missing:
+                logger.warning("Missing summaries for shards %s of %d",
+                               ', '.join(str(index) for index in sorted(missing)), count)
+
+        merged = {
+            'shards': shards,
+            'num_packages': sum(summary.get('num_packages', 0) for summary in summaries),
+            'num_failed': sum(summary.get('num_failed', 0) for summary in summaries),
+            'errors': merge_error_groups([summary.get('errors', {}) for summary in summaries]),
+        }
+        logger.info("Package Crashes by error = \n%s", merged['errors'])
+
+        if self.options.output:
+            write_summary(self.options.output, merged)
+            logger.info("Merged result summary written to %s", self.options.output)
+        else:
+            print(json.dumps(merged, indent=2, sort_keys=True))
+
     def change_to_s3(self, context, resource):
         '''change_to_s3 - performs resource_update. The before and after update hooks
         upload the resource and the resource/package zipfiles to S3
@@ -101,7 +188,9 @@ class MigrateToS3(cli.CkanCommand):
 
                         # Upload resource zipfile to S3
                         # If not blacklisted, will be done automatically as part of resource_update.
-                        upload.upload_resource_zipfile_to_s3(context, resource)
+                        # Zipfiles built on demand are built on the first download instead.
+                        if get_settings().resource_zip_mode == 'eager':
+                            upload.upload_resource_zipfile_to_s3(context, resource)
                 
                 # After updating all the resources, upload package zipfile to S3
                 upload.upload_package_zipfile_to_s3(context, pkg)
@@ -124,3 +213,120 @@ class MigrateToS3(cli.CkanCommand):
             else:
                 errors_dict[error] = [pkg_name]
         return errors_dict
+
+
+class CleanupS3Blobs(cli.CkanCommand):
+    '''Delete content-addressed blobs that no resource refers to anymore
+
+      Usage:
+          s3_blob_gc - lists the blobs that are not referenced by any resource
+
+          s3_blob_gc delete - marks the blobs that are not referenced by any resource, and
+            deletes the ones marked by an earlier run at least --min-age ago that are still
+            not referenced. Blobs referenced again are unmarked.
+
+      Options:
+          --min-age HOURS - only consider blobs older than this, and only delete blobs marked
+            this long ago, so that blobs uploaded or reused for resources that are still being
+            saved are kept (default 24)
+
+    '''
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    max_args = 1
+    min_args = 0
+
+    def __init__(self, name):
+        super(CleanupS3Blobs, self).__init__(name)
+        self.parser.add_option('--min-age', dest='min_age', type='int', default=24,
+                               help='Only consider blobs older than this many hours')
+
+    def command(self):
+        '''Runs on the s3_blob_gc command'''
+        self._load_config()
+        logger = logging.getLogger(__name__)
+
+        delete = len(self.args) > 0 and self.args[0] == 'delete'
+        url_prefix = get_settings().url_prefix
+
+        # Blobs are referenced by the URL of resources, including deleted ones
+        # which can still be restored
+        referenced = set(url for (url,) in model.Session.query(model.Resource.url)
+                         .filter(model.Resource.url.like(url_prefix + upload.BLOB_PREFIX + '%')))
+        if hasattr(model, 'ResourceRevision'):
+            referenced.update(url for (url,) in model.Session.query(model.ResourceRevision.url)
+                              .filter(model.ResourceRevision.url.like(url_prefix + upload.BLOB_PREFIX + '%')))
+        model.Session.remove()
+
+        bucket = upload.setup_s3_bucket()
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=self.options.min_age)
+
+        # Blob key: time it was marked by an earlier run
+        marks = dict((obj.key[len(upload.BLOB_GC_MARK_PREFIX):], obj.last_modified.replace(tzinfo=None))
+                     for obj in bucket.objects.filter(Prefix=upload.BLOB_GC_MARK_PREFIX))
+
+        unreferenced = []
+        blobs = set()
+        for obj in bucket.objects.filter(Prefix=upload.BLOB_PREFIX):
+            if obj.key.endswith('/'):
+                continue
+            blobs.add(obj.key)
+            if url_prefix + obj.key in referenced:
+                # Reused since it was marked
+                if delete and obj.key in marks:
+                    logger.info("Blob %s is referenced again, unmarking it", obj.key)
+                    bucket.Object(upload.BLOB_GC_MARK_PREFIX + obj.key).delete()
+                continue
+            if obj.last_modified.replace(tzinfo=None) > cutoff:
+                continue
+            unreferenced.append(obj.key)
+
+        logger.info("%d unreferenced blobs found", len(unreferenced))
+        for key in unreferenced:
+            if not delete:
+                print(key)
+            elif key not in marks:
+                # A reuse only checks that the blob exists, so the blob is kept for --min-age
+                # to give a resource reusing it meanwhile the time to be committed
+                logger.info("Marking blob %s for deletion", key)
+                bucket.put_object(Key=upload.BLOB_GC_MARK_PREFIX + key, Body='')
+            elif marks[key] <= cutoff:
+                logger.info("Deleting blob %s", key)
+                bucket.Object(key).delete()
+                bucket.Object(upload.BLOB_GC_MARK_PREFIX + key).delete()
+
+        # Marks of blobs deleted otherwise
+        if delete:
+            for key in set(marks) - blobs:
+                bucket.Object(upload.BLOB_GC_MARK_PREFIX + key).delete()
+
+
+def parse_shard(shard):
+    '''parse_shard - parse a shard given as I/N into an (index, count) tuple'''
+    try:
+        index, count = [int(part) for part in shard.split('/')]
+    except ValueError:
+        raise BadCommand('Shard must be given as I/N, got %s' % shard)
+    if count < 1 or not 0 <= index < count:
+        raise BadCommand('Shard index must be between 0 and %d, got %s' % (count - 1, shard))
+    return index, count
+
+
+def shard_of(package_id, count):
+    '''shard_of - stable shard of a package, the same on every host and run'''
+    return int(hashlib.md5(package_id.encode('utf-8')).hexdigest(), 16) % count
+
+
+def merge_error_groups(error_groups):
+    '''merge_error_groups - combine several dicts returned by MigrateToS3.group_errors'''
+    errors_dict = dict()
+    for group in error_groups:
+        for error, pkg_names in group.items():
+            errors_dict.setdefault(error, []).extend(pkg_names)
+    return errors_dict
+
+
+def write_summary(filename, summary):
+    '''write_summary - write a result summary as JSON'''
+    with open(filename, 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2, sort_keys=True)
@@ -7,7 +7,6 @@ import logging
 import os
 
 import mimetypes
-from pylons import config
 from slugify import slugify
 
 import paste.fileapp
@@ -18,6 +17,9 @@ from ckan.controllers.package import PackageController
 from ckan.common import response, request
 from ckan.lib.base import redirect
 
+import ckanext.datagovsg_s3_resources.upload as s3_upload
+from ckanext.datagovsg_s3_resources.settings import get_settings
+
 
 class S3ResourcesPackageController(PackageController):
     '''
@@ -27,7 +29,7 @@ class S3ResourcesPackageController(PackageController):
     Handles package and resource downloads.
     '''
     def __init__(self):
-        self.s3_url_prefix = config.get('ckan.datagovsg_s3_resources.s3_url_prefix')
+        self.s3_url_prefix = get_settings().url_prefix
 
 
     # download the whole dataset together with the metadata
@@ -107,6 +109,10 @@ class S3ResourcesPackageController(PackageController):
             logger = logging.getLogger(__name__)
             logger.error("Error tracking resource download - %s" % exception)
 
+        # Build the resource zip if it is built on demand and missing or out of date
+        if get_settings().resource_zip_mode == 'on_demand':
+            s3_upload.ensure_resource_zipfile(context, rsc)
+
         # Redirect the request to the URL for the resource zip
         pkg = toolkit.get_action('package_show')(context, {'id': id})
         redirect(self.s3_url_prefix
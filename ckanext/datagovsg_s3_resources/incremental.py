@@ -0,0 +1,358 @@
+'''
+incremental.py
+
+Contains the incremental rebuild of zipfiles on S3.
+
+Entries are stored uncompressed and each entry records the digest of its source,
+see manifest.source_digest, as its comment in the central directory. When a
+zipfile is rebuilt, the entries whose source did not change are not downloaded
+and written again: their bytes are copied from the previous zipfile within S3,
+with UploadPartCopy requests on byte ranges of it. Only the changed entries and
+the new central directory are uploaded.
+
+The zipfile is put together by a ZipAssembler, a file object given to
+zipfile.ZipFile that keeps the bytes written locally in a temporary file and
+records the ranges of the previous zipfile in between. Parts of a multipart
+upload must be at least 5 MB, except the last, so ranges smaller than that are
+downloaded and uploaded with the local bytes around them instead.
+'''
+import copy
+import logging
+import struct
+import tempfile
+import zipfile
+
+import ckanext.datagovsg_s3_resources.pipeline as pipeline
+
+# Limits on the parts of a multipart upload
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+
+# Local file header: signature, versions, flags, method, time, date, crc, sizes, name and extra lengths
+LOCAL_HEADER_FORMAT = '<4s2B4HL2L2H'
+LOCAL_HEADER_SIZE = struct.calcsize(LOCAL_HEADER_FORMAT)
+LOCAL_HEADER_SIGNATURE = 'PK\003\004'
+
+# Entries followed by a data descriptor do not have their sizes in the local header
+DATA_DESCRIPTOR_FLAG = 0x08
+
+# Extra field id of the Zip64 sizes and offsets, which zipfile writes itself
+ZIP64_EXTRA_ID = 0x0001
+
+
+class S3RangeFile(object):
+    '''
+    S3RangeFile - Read-only file object over an S3 object, each read is a ranged GetObject
+
+    The reads are conditional on the ETag, so that a zipfile replaced meanwhile is not mixed up with its successor
+    '''
+    def __init__(self, bucket, key, size, etag):
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.position = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        self.position = max(offset, 0)
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        end = self.size if size < 0 else min(self.position + size, self.size)
+        if end <= self.position:
+            return ''
+        data = read_range(self.bucket, self.key, self.etag, self.position, end - self.position)
+        self.position = end
+        return data
+
+    def close(self):
+        pass
+
+
+def read_range(bucket, key, etag, offset, length):
+    '''read_range - reads length bytes of an S3 object from offset, if it still has the given ETag'''
+    return open_range(bucket, key, etag, offset, length).read()
+
+
+def open_range(bucket, key, etag, offset, length):
+    '''open_range - streaming body of length bytes of an S3 object from offset, if it still has the given ETag'''
+    response = bucket.meta.client.get_object(Bucket=bucket.name, Key=key, IfMatch=etag,
+                                             Range='bytes=%d-%d' % (offset, offset + length - 1))
+    return response['Body']
+
+
+class PreviousZipfile(object):
+    '''
+    PreviousZipfile - The zipfile uploaded by the previous build, as a source of entries to reuse
+
+    entries maps each filename to its ZipInfo, for the entries whose source digest was recorded
+    '''
+    def __init__(self, bucket, key, etag, entries):
+        self.bucket = bucket
+        self.key = key
+        self.etag = etag
+        self.entries = entries
+
+    @classmethod
+    def open(cls, bucket, key):
+        '''open - reads the central directory of the zipfile under key, returns None if there is none'''
+        from botocore.exceptions import ClientError
+
+        logger = logging.getLogger(__name__)
+        try:
+            head = bucket.meta.client.head_object(Bucket=bucket.name, Key=key)
+            range_file = S3RangeFile(bucket, key, head['ContentLength'], head['ETag'])
+            infos = zipfile.ZipFile(range_file).infolist()
+        except ClientError:
+            return None
+        except (zipfile.BadZipfile, zipfile.LargeZipFile, struct.error) as error:
+            logger.warning("Zipfile %s cannot be read, rebuilding it in full: %s" % (key, error))
+            return None
+
+        names = [info.filename for info in infos]
+        entries = {}
+        for info in infos:
+            # Entries with unknown sources and duplicated filenames are never reused
+            if info.comment and names.count(info.filename) == 1 and not info.flag_bits & DATA_DESCRIPTOR_FLAG:
+                entries[info.filename] = info
+        return cls(bucket, key, head['ETag'], entries)
+
+    def reusable(self, filename, digest):
+        '''reusable - the ZipInfo of filename if it was built from the source with this digest, else None'''
+        info = self.entries.get(filename)
+        if digest is None or info is None or info.comment != digest:
+            return None
+        return info
+
+    def entry_length(self, info):
+        '''entry_length - length of the local header and data of an entry'''
+        header = read_range(self.bucket, self.key, self.etag, info.header_offset, LOCAL_HEADER_SIZE)
+        fields = struct.unpack(LOCAL_HEADER_FORMAT, header)
+        if fields[0] != LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipfile("Bad local header of %s in %s" % (info.filename, self.key))
+        name_length, extra_length = fields[-2:]
+        return LOCAL_HEADER_SIZE + name_length + extra_length + info.compress_size
+
+
+class ZipAssembler(object):
+    '''
+    ZipAssembler - Write-only file object given to zipfile.ZipFile, made of local bytes and of ranges of a previous zipfile
+
+    The local bytes are kept in a named temporary file. segments lists, in order, ('local', offset in
+    the temporary file, length) and ('remote', offset in the previous zipfile, length).
+    zipfile seeks back to rewrite local headers, so writes may land anywhere in the local bytes.
+    '''
+    def __init__(self):
+        self.temp = tempfile.NamedTemporaryFile()
+        self.segments = []
+        self.position = 0
+        self.size = 0
+
+    def write(self, data):
+        if not data:
+            return
+        if self.position == self.size:
+            self._append_local(data)
+        else:
+            self._overwrite_local(data)
+        self.position += len(data)
+        self.size = max(self.size, self.position)
+
+    def _append_local(self, data):
+        self.temp.seek(0, 2)
+        temp_offset = self.temp.tell()
+        self.temp.write(data)
+        if self.segments and self.segments[-1][0] == 'local':
+            kind, offset, length = self.segments[-1]
+            self.segments[-1] = (kind, offset, length + len(data))
+        else:
+            self.segments.append(('local', temp_offset, len(data)))
+
+    def _overwrite_local(self, data):
+        start = 0
+        for kind, offset, length in self.segments:
+            if start <= self.position and self.position + len(data) <= start + length:
+                if kind != 'local':
+                    break
+                self.temp.seek(offset + self.position - start)
+                self.temp.write(data)
+                return
+            start += length
+        raise IOError("Cannot write over bytes copied from the previous zipfile")
+
+    def add_remote(self, offset, length):
+        '''add_remote - appends length bytes of the previous zipfile from offset'''
+        if self.position != self.size:
+            raise IOError("Bytes of the previous zipfile can only be appended")
+        self.segments.append(('remote', offset, length))
+        self.position += length
+        self.size += length
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        self.temp.flush()
+
+    def close(self):
+        self.temp.close()
+
+    @property
+    def has_remote(self):
+        '''has_remote - True if any bytes come from the previous zipfile'''
+        return any(kind == 'remote' for kind, _, _ in self.segments)
+
+    def local_path(self):
+        '''local_path - path of the temporary file, holding the whole zipfile if nothing comes from the previous one'''
+        self.temp.flush()
+        return self.temp.name
+
+
+def add_reused_entry(zip_archive, previous, info):
+    '''
+    add_reused_entry - Adds an entry of the previous zipfile to zip_archive without writing its bytes
+
+    zip_archive must be writing to a ZipAssembler. The bytes are copied from the previous
+    zipfile when uploading, only the central directory record is written locally.
+    '''
+    assembler = zip_archive.fp
+    length = previous.entry_length(info)
+    reused = copy.copy(info)
+    reused.header_offset = assembler.tell()
+    # zipfile adds the Zip64 field itself from the sizes and the new offset
+    reused.extra = strip_extra(info.extra, ZIP64_EXTRA_ID)
+    assembler.add_remote(info.header_offset, length)
+    zip_archive.filelist.append(reused)
+    zip_archive.NameToInfo[reused.filename] = reused
+    zip_archive._didModify = True
+
+
+def strip_extra(extra, extra_id):
+    '''strip_extra - removes the fields with extra_id from the extra field of a ZipInfo'''
+    fields = []
+    while len(extra) >= 4:
+        field_id, field_length = struct.unpack('<HH', extra[:4])
+        if field_id != extra_id:
+            fields.append(extra[:4 + field_length])
+        extra = extra[4 + field_length:]
+    return ''.join(fields)
+
+
+def plan_parts(segments, part_size):
+    '''
+    plan_parts - Splits the segments of a ZipAssembler into the parts of a multipart upload
+
+    Returns a list of parts, each ('copy', offset, length) for a range of the previous zipfile
+    copied within S3, or ('upload', pieces) for bytes uploaded, where pieces are segments. Ranges
+    of the previous zipfile are copied if they can make parts of at least MIN_PART_SIZE, after
+    topping up the uploaded bytes before them to that size. Uploaded parts are at most part_size.
+    '''
+    part_size = max(part_size, MIN_PART_SIZE)
+    parts = []
+    pieces = []
+    buffered = 0
+    for kind, offset, length in segments:
+        if kind == 'remote':
+            top_up = max(MIN_PART_SIZE - buffered, 0) if buffered else 0
+            if length - top_up >= MIN_PART_SIZE:
+                if buffered:
+                    if top_up:
+                        pieces.append((kind, offset, top_up))
+                    parts.append(('upload', pieces))
+                    pieces, buffered = [], 0
+                parts.extend(copy_parts(offset + top_up, length - top_up))
+                continue
+        while length:
+            take = min(length, part_size - buffered)
+            pieces.append((kind, offset, take))
+            buffered += take
+            offset += take
+            length -= take
+            if buffered == part_size:
+                parts.append(('upload', pieces))
+                pieces, buffered = [], 0
+    if pieces:
+        parts.append(('upload', pieces))
+    return parts
+
+
+def copy_parts(offset, length):
+    '''copy_parts - splits a range of at least MIN_PART_SIZE into copied parts of at most MAX_PART_SIZE'''
+    count = (length + MAX_PART_SIZE - 1) // MAX_PART_SIZE
+    size = (length + count - 1) // count
+    parts = []
+    while length:
+        take = min(size, length)
+        parts.append(('copy', offset, take))
+        offset += take
+        length -= take
+    return parts
+
+
+def upload_assembled(bucket, key, assembler, previous, extra_args, part_size):
+    '''
+    upload_assembled - Uploads the zipfile of a ZipAssembler with a multipart upload
+
+    Ranges of the previous zipfile are copied with UploadPartCopy, on the condition that it
+    was not replaced meanwhile. The upload is aborted if any part fails.
+    '''
+    logger = logging.getLogger(__name__)
+    client = bucket.meta.client
+    upload_id = client.create_multipart_upload(Bucket=bucket.name, Key=key, **extra_args)['UploadId']
+    try:
+        completed = []
+        copied = 0
+        for number, part in enumerate(plan_parts(assembler.segments, part_size), 1):
+            if part[0] == 'copy':
+                _, offset, length = part
+                response = client.upload_part_copy(
+                    Bucket=bucket.name, Key=key, UploadId=upload_id, PartNumber=number,
+                    CopySource={'Bucket': bucket.name, 'Key': previous.key},
+                    CopySourceIfMatch=previous.etag,
+                    CopySourceRange='bytes=%d-%d' % (offset, offset + length - 1))
+                etag = response['CopyPartResult']['ETag']
+                copied += length
+            else:
+                with tempfile.TemporaryFile() as body:
+                    write_pieces(body, assembler, previous, part[1])
+                    body.seek(0)
+                    response = client.upload_part(Bucket=bucket.name, Key=key, UploadId=upload_id,
+                                                  PartNumber=number, Body=body)
+                etag = response['ETag']
+            completed.append({'ETag': etag, 'PartNumber': number})
+        client.complete_multipart_upload(Bucket=bucket.name, Key=key, UploadId=upload_id,
+                                         MultipartUpload={'Parts': completed})
+        logger.info("Copied %d of %d bytes of zipfile %s from its previous build" % (copied, assembler.size, key))
+    except Exception:
+        client.abort_multipart_upload(Bucket=bucket.name, Key=key, UploadId=upload_id)
+        raise
+
+
+def write_pieces(body, assembler, previous, pieces):
+    '''write_pieces - writes the bytes of an uploaded part, from the temporary file and from the previous zipfile'''
+    for kind, offset, length in pieces:
+        if kind == 'local':
+            assembler.temp.seek(offset)
+            source = assembler.temp
+        else:
+            source = open_range(previous.bucket, previous.key, previous.etag, offset, length)
+        # Copied in chunks, so that a part is never held in memory
+        while length:
+            data = source.read(min(length, pipeline.CHUNK_SIZE))
+            if not data:
+                raise IOError("Zipfile %s ended early" % previous.key)
+            body.write(data)
+            length -= len(data)
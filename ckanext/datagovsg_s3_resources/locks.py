@@ -0,0 +1,224 @@
+'''
+locks.py
+
+Contains the per-package and per-resource locks used to make sure that only one
+process at a time builds a zipfile.
+
+When a build is requested while another process holds the lock, the request is
+recorded instead of building, and the process holding the lock builds again
+once it is done. Concurrent requests therefore collapse into a single build
+that still picks up the latest changes. For that, builds must only be requested
+once the changes are committed, and every build must read them afresh, see
+upload.upload_package_zipfile_after_commit.
+
+Backends, chosen by ckan.datagovsg_s3_resources.lock_backend:
+- file - flock on files in ckan.datagovsg_s3_resources.lock_dir, for workers on one host
+- postgres - advisory locks on the CKAN database, for workers on several hosts
+- none - no locking
+'''
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import struct
+
+from ckanext.datagovsg_s3_resources.settings import get_settings
+
+
+def get_lock(name):
+    '''get_lock - returns the lock for name using the configured backend'''
+    settings = get_settings()
+    if settings.lock_backend == 'postgres':
+        return AdvisoryLock(name)
+    elif settings.lock_backend == 'none':
+        return NullLock(name)
+    return FileLock(name, settings.lock_dir)
+
+
+def run_exclusively(lock, build):
+    '''
+    run_exclusively - Runs build while holding lock
+
+    If the lock is held by another process, a rebuild is requested from it instead.
+    Returns True if build ran in this process.
+    '''
+    logger = logging.getLogger(__name__)
+
+    if not lock.acquire():
+        lock.request_rebuild()
+        # The holder may have released the lock before seeing the request
+        if not lock.acquire():
+            logger.info("%s is being built by another process, rebuild requested" % lock.name)
+            return False
+
+    while True:
+        try:
+            # Requests made before this build started are covered by it
+            lock.pop_rebuild_request()
+            build()
+            while lock.pop_rebuild_request():
+                logger.info("Rebuild of %s requested while building" % lock.name)
+                build()
+        finally:
+            lock.release()
+
+        # A request may have come in between the last check and the release
+        if not (lock.pop_rebuild_request() and lock.acquire()):
+            return True
+
+
+class NullLock(object):
+    '''
+    class NullLock
+
+    Lock that is always acquired, for when locking is disabled
+    '''
+    def __init__(self, name):
+        self.name = name
+
+    def acquire(self, blocking=False):
+        '''acquire - always succeeds'''
+        return True
+
+    def release(self):
+        '''release - nothing to release'''
+        pass
+
+    def request_rebuild(self):
+        '''request_rebuild - nobody else can be building'''
+        pass
+
+    def pop_rebuild_request(self):
+        '''pop_rebuild_request - there are never pending requests'''
+        return False
+
+
+class FileLock(object):
+    '''
+    class FileLock
+
+    Lock held with flock on <lock_dir>/<name>.lock.
+    Rebuild requests are recorded by creating <lock_dir>/<name>.rebuild.
+    '''
+    def __init__(self, name, lock_dir):
+        self.name = name
+        self.path = os.path.join(lock_dir, name + '.lock')
+        self.request_path = os.path.join(lock_dir, name + '.rebuild')
+        self._fd = None
+
+    def acquire(self, blocking=False):
+        '''acquire - take the lock, returns False if it is held elsewhere and not blocking'''
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as error:
+            os.close(fd)
+            if error.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        self._fd = fd
+        return True
+
+    def release(self):
+        '''release - release the lock. The lock file is kept, removing it would race with acquire'''
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+
+    def request_rebuild(self):
+        '''request_rebuild - ask the process holding the lock to build again'''
+        open(self.request_path, 'a').close()
+
+    def pop_rebuild_request(self):
+        '''pop_rebuild_request - returns True and clears the request if a rebuild was requested'''
+        try:
+            os.remove(self.request_path)
+        except OSError as error:
+            if error.errno == errno.ENOENT:
+                return False
+            raise
+        return True
+
+
+class AdvisoryLock(object):
+    '''
+    class AdvisoryLock
+
+    Lock held with a Postgres session level advisory lock on the CKAN database.
+    Rebuild requests are sent with NOTIFY to the connection holding the lock.
+    '''
+    def __init__(self, name):
+        self.name = name
+        digest = hashlib.md5(name.encode('utf-8'))
+        # Advisory lock keys are signed 64 bit integers
+        self.key = struct.unpack('>q', digest.digest()[:8])[0]
+        self.channel = 'datagovsg_s3_resources_' + digest.hexdigest()
+        self._connection = None
+        self._rebuild_requested = False
+
+    def _connect(self):
+        '''_connect - a dedicated connection from the CKAN pool, outside of any transaction'''
+        import ckan.model as model
+        connection = model.meta.engine.raw_connection()
+        connection.connection.autocommit = True
+        return connection
+
+    def _close(self, connection):
+        '''_close - return the connection to the pool'''
+        connection.connection.autocommit = False
+        connection.close()
+
+    def acquire(self, blocking=False):
+        '''acquire - take the lock, returns False if it is held elsewhere and not blocking'''
+        connection = self._connect()
+        cursor = connection.cursor()
+        if blocking:
+            cursor.execute('SELECT pg_advisory_lock(%s)', (self.key,))
+            acquired = True
+        else:
+            cursor.execute('SELECT pg_try_advisory_lock(%s)', (self.key,))
+            acquired = cursor.fetchone()[0]
+
+        if not acquired:
+            self._close(connection)
+            return False
+
+        cursor.execute('LISTEN ' + self.channel)
+        self._connection = connection
+        self._rebuild_requested = False
+        return True
+
+    def release(self):
+        '''release - release the lock, collecting any requests that came in while it was held'''
+        connection = self._connection
+        self._connection = None
+        cursor = connection.cursor()
+        cursor.execute('SELECT pg_advisory_unlock(%s)', (self.key,))
+        self._rebuild_requested = self._poll(connection) or self._rebuild_requested
+        cursor.execute('UNLISTEN ' + self.channel)
+        self._close(connection)
+
+    def request_rebuild(self):
+        '''request_rebuild - ask the process holding the lock to build again'''
+        connection = self._connect()
+        try:
+            connection.cursor().execute('NOTIFY ' + self.channel)
+        finally:
+            self._close(connection)
+
+    def pop_rebuild_request(self):
+        '''pop_rebuild_request - returns True and clears the request if a rebuild was requested'''
+        if self._connection is not None:
+            self._rebuild_requested = self._poll(self._connection) or self._rebuild_requested
+        requested = self._rebuild_requested
+        self._rebuild_requested = False
+        return requested
+
+    def _poll(self, connection):
+        '''_poll - returns True if notifications were received on the connection'''
+        connection.connection.poll()
+        notifies = connection.connection.notifies
+        received = len(notifies) > 0
+        del notifies[:]
+        return received
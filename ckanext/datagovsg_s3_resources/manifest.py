@@ -0,0 +1,75 @@
+'''
+manifest.py
+
+Contains the manifests used to skip rebuilding zipfiles that did not change.
+
+A manifest records a hash of the metadata and, for every entry of a zipfile, a
+digest of the source the entry was built from. The digest of the manifest is
+stored in the object metadata of the zipfile, in the same PUT as the zipfile
+itself, so that an up to date zipfile is recognized with a single HEAD request.
+'''
+import hashlib
+import json
+import os
+
+import ckan.lib.uploader as uploader
+
+# Key of the zipfile's S3 object metadata holding the manifest digest
+MANIFEST_DIGEST_KEY = 'manifest-sha256'
+
+
+def source_digest(resource):
+    '''
+    source_digest - digest identifying the contents of a resource without reading them
+
+    Returns None if the contents cannot be identified, e.g. for resources on external URLs
+    '''
+    if resource.get('url_type') == 'upload':
+        filepath = uploader.ResourceUpload(resource).get_path(resource['id'])
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return None
+        parts = ['upload', filepath, str(stat.st_size), repr(stat.st_mtime)]
+    elif resource.get('url_type') == 's3':
+        # Resources are uploaded to timestamped keys, so new contents always get a new URL
+        parts = ['s3', resource.get('url', ''), resource.get('hash') or '']
+    else:
+        return None
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def build_manifest(metadata_text, entries):
+    '''build_manifest - manifest of a zipfile built from the metadata and a list of (filename, resource)'''
+    digests = {}
+    for filename, resource in entries:
+        # Entries sharing a filename cannot be told apart, treat them as unknown
+        digests[filename] = None if filename in digests else source_digest(resource)
+    return {
+        'metadata': hashlib.sha256(metadata_text).hexdigest(),
+        'entries': digests,
+    }
+
+
+def manifest_digest(manifest):
+    '''manifest_digest - digest of a manifest, stored in the zipfile's object metadata'''
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True)).hexdigest()
+
+
+def is_current(bucket, key, manifest, allow_unknown=False):
+    '''
+    is_current - True if the zipfile on S3 was built from exactly this manifest
+
+    Entries from unknown sources may have changed at any time, so the zipfile is only
+    considered current with such entries if allow_unknown is set
+    '''
+    from botocore.exceptions import ClientError
+
+    if not allow_unknown and None in manifest['entries'].values():
+        return False
+    try:
+        head = bucket.meta.client.head_object(Bucket=bucket.name, Key=key)
+    except ClientError:
+        return False
+    return head.get('Metadata', {}).get(MANIFEST_DIGEST_KEY) == manifest_digest(manifest)
+
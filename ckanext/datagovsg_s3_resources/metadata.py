@@ -0,0 +1,94 @@
+'''
+metadata.py
+
+Contains the MetadataYAMLDumper class to generate the metadata for zipfiles.
+
+Kept apart from upload.py so that yaml is only imported once a zipfile is built.
+'''
+import StringIO
+import collections
+
+import yaml
+
+
+def metadata_yaml(pkg, metadata):
+    '''metadata_yaml - returns the metadata text written into the package and resource zipfiles'''
+    metadata_yaml_buff = StringIO.StringIO()
+    metadata_yaml_buff.write(unicode("# Metadata for %s\r\n" % pkg[
+                             "title"]).encode('ascii', 'ignore'))
+    yaml.dump(prettify_json(metadata),
+              metadata_yaml_buff, Dumper=MetadataYAMLDumper)
+    return metadata_yaml_buff.getvalue()
+
+
+class MetadataYAMLDumper(yaml.SafeDumper):
+    '''
+    class MetadataYAMLDumper
+
+    Used to generate metadata for the CKAN resources/packages
+    '''
+    def __init__(self, *args, **kws):
+        kws['default_flow_style'] = False
+        kws['explicit_start'] = True
+        kws['line_break'] = '\r\n'
+
+        super(MetadataYAMLDumper, self).__init__(*args, **kws)
+
+    def expect_block_sequence(self):
+        '''expect_block_sequence - add the first indentation for list'''
+        self.increase_indent(flow=False, indentless=False)
+        self.state = self.expect_first_block_sequence_item
+
+    def expect_block_sequence_item(self, first=False):
+        '''expect_block_sequence_item - modify this to add extra line breaks'''
+        if not first and isinstance(self.event, yaml.SequenceEndEvent):
+            self.indent = self.indents.pop()
+            self.state = self.states.pop()
+        else:
+            self.write_indent()
+            self.write_indicator(u'-', True, indention=True)
+            # add a line break for sequence items which have mapping type
+            if isinstance(self.event, yaml.MappingStartEvent):
+                self.write_line_break()
+            self.states.append(self.expect_block_sequence_item)
+            self.expect_node(sequence=True)
+
+    def represent_odict(self, data):
+        '''represent_odict - represent OrderedDict'''
+        value = list()
+        node = yaml.nodes.MappingNode(
+            'tag:yaml.org,2002:map', value, flow_style=None)
+        if self.alias_key is not None:
+            self.represented_objects[self.alias_key] = node
+        for item_key, item_value in data.items():
+            node_key = self.represent_data(item_key)
+            node_value = self.represent_data(item_value)
+            value.append((node_key, node_value))
+        node.flow_style = False
+        return node
+
+    def choose_scalar_style(self):
+        '''choose_scalar_style - single quotes'''
+        is_dict_key = self.states[-1] == self.expect_block_mapping_simple_value
+        if is_dict_key:
+            return None
+        return "'"
+
+MetadataYAMLDumper.add_representer(
+    collections.OrderedDict, MetadataYAMLDumper.represent_odict)
+
+
+# Helper functions
+
+def prettify_json(json):
+    '''prettify_json - removes leading and trailing whitespace'''
+    if isinstance(json, dict):
+        for key in json.keys():
+            prettified_name = key.replace('_', ' ').title()
+            json[prettified_name] = prettify_json(json.pop(key))
+    elif isinstance(json, list):
+        return [prettify_json(obj) for obj in json]
+    elif isinstance(json, basestring):
+        # remove leading and trailing white spaces, new lines, tabs
+        json = json.strip(' \t\n\r')
+    return json
@@ -9,6 +9,7 @@ import logging
 from routes.mapper import SubMapper
 import ckan.plugins as plugins
 import ckanext.datagovsg_s3_resources.upload as upload
+import ckanext.datagovsg_s3_resources.settings as settings
 
 
 class DatagovsgS3ResourcesPackagePlugin(plugins.SingletonPlugin):
@@ -17,13 +18,23 @@ class DatagovsgS3ResourcesPackagePlugin(plugins.SingletonPlugin):
     Extends plugins.SingletonPlugin
 
     1. Connects package download route
-    2. Hooks into after_update to upload package zipfile to S3
+    2. Hooks into after_update to upload package zipfile to S3 once the update is committed
     '''
 
+    plugins.implements(plugins.IConfigurable, inherit=True)
     plugins.implements(plugins.IPackageController, inherit=True)
     plugins.implements(plugins.IRoutes, inherit=True)
 
 
+    ##############################################################
+    # IConfigurable ##############################################
+    ##############################################################
+
+    def configure(self, config):
+        '''Parses the config options once'''
+        settings.configure(config)
+
+
     ##############################################################
     # IRoutes ####################################################
     ##############################################################
@@ -62,7 +73,8 @@ class DatagovsgS3ResourcesPackagePlugin(plugins.SingletonPlugin):
                 logger.error("Required S3 config options missing. Please check if required config options exist.")
                 raise Exception('Required S3 config options missing')
             else:
-                upload.upload_package_zipfile_to_s3(context, pkg_dict)
+                # after_update runs before package_update commits
+                upload.upload_package_zipfile_after_commit(pkg_dict)
         else:
             # Skip package_zipfile upload
             logger.info("Package after_update originating from resource create/update... Skipping package zipfile upload")
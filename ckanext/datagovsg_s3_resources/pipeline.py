@@ -0,0 +1,203 @@
+'''
+pipeline.py
+
+Contains the streaming pipeline used when uploading resources to S3.
+
+The resource body (an uploaded cgi.FieldStorage file, a file on the CKAN
+filestore or an HTTP response) is wrapped in a ResourceStream, which computes
+the MD5/SHA-256 digests, counts the bytes and sniffs the content type while
+the body is being fed to the S3 upload, so that the body is only read once.
+
+Text resources are gzip compressed on the way to S3 by a GzipStream, and objects
+stored compressed are decompressed on the way back by a GunzipStream.
+'''
+import hashlib
+import zlib
+
+# Size of the chunks streamed bodies are copied in
+CHUNK_SIZE = 1024 * 1024
+
+# Number of bytes peeked at the start of the body to sniff the content type
+SNIFF_SIZE = 512
+
+# Known magic numbers - (prefix, content type, extension)
+# Checked in order, so more specific prefixes must come first
+MAGIC_NUMBERS = [
+    ('%PDF-', 'application/pdf', '.pdf'),
+    ('PK\x03\x04', 'application/zip', '.zip'),
+    ('PK\x05\x06', 'application/zip', '.zip'),
+    ('\x1f\x8b', 'application/x-gzip', '.gz'),
+    ('\x89PNG\r\n\x1a\n', 'image/png', '.png'),
+    ('\xff\xd8\xff', 'image/jpeg', '.jpg'),
+    ('GIF87a', 'image/gif', '.gif'),
+    ('GIF89a', 'image/gif', '.gif'),
+    ('II*\x00', 'image/tiff', '.tif'),
+    ('MM\x00*', 'image/tiff', '.tif'),
+    ('{\\rtf', 'application/rtf', '.rtf'),
+    ('<?xml', 'application/xml', '.xml'),
+]
+
+# Sniffed content types that are already compressed and are not worth gzipping
+COMPRESSED_CONTENT_TYPES = ['application/zip', 'application/x-gzip']
+
+# Compression level of GzipStream, trading a little size for much faster uploads
+GZIP_LEVEL = 6
+
+# wbits making zlib read and write the gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def sniff_content_type(head):
+    '''sniff_content_type - guess the content type and extension from the first bytes of a body
+
+    Returns a (content_type, extension) tuple, or (None, None) if nothing matched'''
+    for magic, content_type, extension in MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return content_type, extension
+
+    # Fall back to telling text apart from binary data
+    if not head or '\x00' in head:
+        return None, None
+    stripped = head.lstrip(' \t\r\n')
+    if stripped.startswith('{') or stripped.startswith('['):
+        return 'application/json', '.json'
+    return 'text/plain', '.txt'
+
+
+class ResourceStream(object):
+    '''
+    class ResourceStream
+
+    Read-only file-like wrapper around a resource body. Keeps running MD5 and
+    SHA-256 digests and a byte count of everything read through it, and peeks
+    at the first SNIFF_SIZE bytes on construction to sniff the content type.
+
+    The digests and size are only complete once the body has been read to the end.
+    '''
+    def __init__(self, fileobj, sniff_size=SNIFF_SIZE):
+        self._fileobj = fileobj
+        self._md5 = hashlib.md5()
+        self._sha256 = hashlib.sha256()
+        self.size = 0
+
+        # Peek at the head of the body. It is replayed on the first reads.
+        self._head = self._read_fully(sniff_size)
+        self.sniffed_content_type, self.sniffed_extension = sniff_content_type(self._head)
+
+    def _read_fully(self, size):
+        '''_read_fully - read exactly size bytes unless the body ends first'''
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            chunk = self._fileobj.read(remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return ''.join(chunks)
+
+    def read(self, size=-1):
+        '''
+        read - read from the replayed head first, then from the underlying body
+
+        Returns exactly size bytes unless the body ends first, as s3transfer decides
+        whether to use a multipart upload from the length of a single read
+        '''
+        if size is None or size < 0:
+            data = self._head + self._fileobj.read()
+            self._head = ''
+        else:
+            data = self._head[:size]
+            self._head = self._head[size:]
+            if len(data) < size:
+                data += self._read_fully(size - len(data))
+
+        if data:
+            self._md5.update(data)
+            self._sha256.update(data)
+            self.size += len(data)
+        return data
+
+    @property
+    def md5(self):
+        '''md5 - hex digest of the bytes read so far'''
+        return self._md5.hexdigest()
+
+    @property
+    def sha256(self):
+        '''sha256 - hex digest of the bytes read so far'''
+        return self._sha256.hexdigest()
+
+    def close(self):
+        '''close - close the underlying body'''
+        self._fileobj.close()
+
+
+class GzipStream(object):
+    '''
+    class GzipStream
+
+    Read-only file-like wrapper that gzip compresses a body while it is read, so that
+    it can be uploaded with Content-Encoding: gzip without being spooled first
+    '''
+    def __init__(self, fileobj, level=GZIP_LEVEL):
+        self._fileobj = fileobj
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+        self._buffer = ''
+        self._eof = False
+
+    def read(self, size=-1):
+        '''read - compress chunks of the body until size compressed bytes are available'''
+        while not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            chunk = self._fileobj.read(CHUNK_SIZE)
+            if chunk:
+                self._buffer += self._compressor.compress(chunk)
+            else:
+                self._buffer += self._compressor.flush()
+                self._eof = True
+
+        if size is None or size < 0:
+            data, self._buffer = self._buffer, ''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        '''close - close the underlying body'''
+        self._fileobj.close()
+
+
+class GunzipStream(object):
+    '''
+    class GunzipStream
+
+    Read-only file-like wrapper that decompresses a gzip body while it is read.
+    At most CHUNK_SIZE bytes are inflated at a time, however well the body compresses.
+    '''
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._decompressor = zlib.decompressobj(GZIP_WBITS)
+        self._buffer = ''
+        self._eof = False
+
+    def read(self, size=-1):
+        '''read - decompress the body until size bytes are available'''
+        while not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            data = self._decompressor.unconsumed_tail
+            if not data:
+                data = self._fileobj.read(CHUNK_SIZE)
+            if data:
+                self._buffer += self._decompressor.decompress(data, CHUNK_SIZE)
+            else:
+                self._buffer += self._decompressor.flush()
+                self._eof = True
+
+        if size is None or size < 0:
+            data, self._buffer = self._buffer, ''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        '''close - close the underlying body'''
+        self._fileobj.close()
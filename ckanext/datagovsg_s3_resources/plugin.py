@@ -8,7 +8,9 @@ import logging
 import datetime
 import ckan.plugins as plugins
 from routes.mapper import SubMapper
+import ckanext.datagovsg_s3_resources.actions as actions
 import ckanext.datagovsg_s3_resources.upload as upload
+import ckanext.datagovsg_s3_resources.settings as settings
 
 
 class DatagovsgS3ResourcesPlugin(plugins.SingletonPlugin):
@@ -19,11 +21,44 @@ class DatagovsgS3ResourcesPlugin(plugins.SingletonPlugin):
     1. Connects package and resource download routes
     2. Hooks into before_create, before_update to upload resource to S3
     3. Hooks into after_create, after_update to upload resource zipfile to S3
+    4. Adds the s3_resources_bulk_sync action
     '''
 
+    plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
+    plugins.implements(plugins.IConfigurable, inherit=True)
     plugins.implements(plugins.IResourceController, inherit=True)
     plugins.implements(plugins.IRoutes, inherit=True)
 
+    ##############################################################
+    # IActions ###################################################
+    ##############################################################
+
+    def get_actions(self):
+        '''Adds the action to upload many resources to S3 in one call'''
+        return {'s3_resources_bulk_sync': actions.s3_resources_bulk_sync}
+
+
+    ##############################################################
+    # IAuthFunctions #############################################
+    ##############################################################
+
+    def get_auth_functions(self):
+        '''Adds the auth function of s3_resources_bulk_sync'''
+        return {'s3_resources_bulk_sync': actions.s3_resources_bulk_sync_auth}
+
+
+    ##############################################################
+    # IConfigurable ##############################################
+    ##############################################################
+
+    def configure(self, config):
+        '''Parses the config options once, and warms up the S3 connection if configured to'''
+        s3_settings = settings.configure(config)
+        if s3_settings.warm_up_s3_client:
+            upload.register_warm_up()
+
+
     ##############################################################
     # IRoutes ####################################################
     ##############################################################
@@ -88,8 +123,11 @@ class DatagovsgS3ResourcesPlugin(plugins.SingletonPlugin):
 
     def after_create_or_update(self, context, resource):
         '''Uploads resource zip file to S3
-        Done after create/update instead of before to ensure metadata is generated correctly'''
-        upload.upload_resource_zipfile_to_s3(context, resource)
+        Done after create/update instead of before to ensure metadata is generated correctly
+
+        Skipped when resource zipfiles are built on demand, on the first download'''
+        if settings.get_settings().resource_zip_mode == 'eager':
+            upload.upload_resource_zipfile_to_s3(context, resource)
 
         # Remove 'resource_create_or_update' in context. See documentation in 'before_create_or_update'
         # for more details
@@ -106,8 +144,22 @@ class DatagovsgS3ResourcesPlugin(plugins.SingletonPlugin):
         '''after_create - Runs after resource_create.'''
         self.after_create_or_update(context, resource)
 
-    def before_update(self, context, _, resource):
-        '''Runs before resource_update. Modifies resource destructively to put in the S3 URL'''
+    def before_update(self, context, current, resource):
+        '''Runs before resource_update. Modifies resource destructively to put in the S3 URL
+
+        If only the metadata changed and the file is already in our bucket, the existing
+        S3 object is kept instead of being uploaded again'''
+        if upload.config_exists() and upload.is_metadata_only_update(current, resource):
+            logger = logging.getLogger(__name__)
+            logger.info("Metadata-only update of resource %s, keeping the existing S3 object" % resource.get('name', ''))
+            upload.keep_s3_object(current, resource)
+            # e.g. a rename that changes the slug. The object is copied on the S3 side.
+            if upload.needs_new_s3_key(context, resource):
+                upload.upload_resource_to_s3(context, resource, keep_digests=True)
+            # Read in after_update. The zipfiles hold the metadata, so they are still rebuilt,
+            # copying the unchanged file from the previous zipfiles within S3, see incremental.py
+            context['s3_resources_metadata_only_update'] = True
+            return
         self.before_create_or_update(context, resource)
 
     def after_update(self, context, resource):
@@ -117,6 +169,10 @@ class DatagovsgS3ResourcesPlugin(plugins.SingletonPlugin):
         function for more details.'''
         self.after_create_or_update(context, resource)
 
+        # The file did not change, there is nothing new to push to the datastore
+        if context.pop('s3_resources_metadata_only_update', False):
+            return
+
         # Push data to datastore
         # Unfortunately we have to do this here because datapusher currently runs on the
         # IResourceUrlChange.notify hook which is getting passed as input the OLD resource
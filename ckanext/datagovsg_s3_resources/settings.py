@@ -0,0 +1,108 @@
+'''
+settings.py
+
+Contains the S3ResourcesSettings object, which holds the extension's config
+options. The options are parsed and validated once, when the plugins are
+configured, instead of on every resource hook.
+'''
+import logging
+import tempfile
+
+from paste.deploy.converters import asbool
+
+CONFIG_PREFIX = 'ckan.datagovsg_s3_resources.'
+
+# Config options that must be set for the extension to work
+REQUIRED_OPTIONS = [
+    's3_aws_access_key_id',
+    's3_aws_secret_access_key',
+    's3_bucket_name',
+    's3_url_prefix',
+]
+
+# When resource zipfiles are built, see README
+RESOURCE_ZIP_MODES = ['eager', 'on_demand']
+
+# Backends available to lock zipfile builds, see locks.py
+LOCK_BACKENDS = ['file', 'postgres', 'none']
+
+# Resource objects are stored under keys that never change, so they are cached for a year by default
+DEFAULT_CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+_settings = None
+
+
+class S3ResourcesSettings(object):
+    '''
+    class S3ResourcesSettings
+
+    Parsed config options of the extension
+    '''
+    def __init__(self, config):
+        self.aws_access_key_id = config.get(CONFIG_PREFIX + 's3_aws_access_key_id')
+        self.aws_secret_access_key = config.get(CONFIG_PREFIX + 's3_aws_secret_access_key')
+        self.aws_region_name = config.get(CONFIG_PREFIX + 's3_aws_region_name') or None
+        self.bucket_name = config.get(CONFIG_PREFIX + 's3_bucket_name')
+        self.url_prefix = config.get(CONFIG_PREFIX + 's3_url_prefix')
+        self.endpoint_url = config.get(CONFIG_PREFIX + 's3_endpoint_url') or None
+        self.upload_filetype_blacklist = frozenset(
+            t.lower() for t in config.get(CONFIG_PREFIX + 'upload_filetype_blacklist', '').split())
+        self.warm_up_s3_client = asbool(config.get(CONFIG_PREFIX + 'warm_up_s3_client', False))
+        self.content_addressed_storage = asbool(
+            config.get(CONFIG_PREFIX + 'content_addressed_storage', False))
+        self.transfer_chunk_size = int(
+            config.get(CONFIG_PREFIX + 's3_transfer_chunk_size', 8 * 1024 * 1024))
+        self.transfer_concurrency = int(config.get(CONFIG_PREFIX + 's3_transfer_concurrency', 10))
+        self.bulk_sync_concurrency = int(config.get(CONFIG_PREFIX + 'bulk_sync_concurrency', 4))
+        self.resource_zip_mode = config.get(CONFIG_PREFIX + 'resource_zip_mode', 'eager')
+        self.lock_backend = config.get(CONFIG_PREFIX + 'lock_backend', 'file')
+        self.lock_dir = config.get(CONFIG_PREFIX + 'lock_dir') or tempfile.gettempdir()
+        self.gzip_formats = frozenset(
+            t.lower() for t in config.get(CONFIG_PREFIX + 'gzip_formats', '').split())
+        self.cache_max_age = int(config.get(CONFIG_PREFIX + 'cache_max_age', DEFAULT_CACHE_MAX_AGE))
+        # Per-format overrides, e.g. ckan.datagovsg_s3_resources.cache_max_age.csv = 3600
+        self.format_cache_max_age = dict(
+            (key[len(CONFIG_PREFIX + 'cache_max_age.'):].lower(), int(value))
+            for key, value in config.items()
+            if key.startswith(CONFIG_PREFIX + 'cache_max_age.'))
+
+        self.missing_options = [option for option in REQUIRED_OPTIONS
+                                if config.get(CONFIG_PREFIX + option) is None]
+
+    @property
+    def is_complete(self):
+        '''is_complete - True if all the required config options are set'''
+        return not self.missing_options
+
+    def cache_max_age_for(self, resource_format):
+        '''cache_max_age_for - seconds objects of the format may be cached for, 0 to send no cache headers'''
+        return self.format_cache_max_age.get(resource_format, self.cache_max_age)
+
+
+def configure(config):
+    '''configure - parse the config options. Called from the plugins' configure hooks'''
+    global _settings
+    _settings = S3ResourcesSettings(config)
+    if not _settings.is_complete:
+        logger = logging.getLogger(__name__)
+        logger.error("Required S3 config options missing: %s" % ', '.join(
+            CONFIG_PREFIX + option for option in _settings.missing_options))
+    if _settings.lock_backend not in LOCK_BACKENDS:
+        logger = logging.getLogger(__name__)
+        logger.error("Unknown %slock_backend %s, falling back to file locks" % (
+            CONFIG_PREFIX, _settings.lock_backend))
+        _settings.lock_backend = 'file'
+    if _settings.resource_zip_mode not in RESOURCE_ZIP_MODES:
+        logger = logging.getLogger(__name__)
+        logger.error("Unknown %sresource_zip_mode %s, falling back to eager" % (
+            CONFIG_PREFIX, _settings.resource_zip_mode))
+        _settings.resource_zip_mode = 'eager'
+    return _settings
+
+
+def get_settings():
+    '''get_settings - returns the parsed config options, parsing them if the plugins were not configured'''
+    if _settings is None:
+        from pylons import config
+        return configure(config)
+    return _settings
@@ -0,0 +1,96 @@
+'''Tests for the incremental zipfile rebuild in incremental.py'''
+import os
+import unittest
+import zipfile
+from StringIO import StringIO
+
+import mock
+
+import ckanext.datagovsg_s3_resources.incremental as incremental
+
+MB = 1024 * 1024
+
+
+def build_previous_zipfile(files):
+    '''build_previous_zipfile - bytes of a zipfile of (filename, data, digest)'''
+    buff = StringIO()
+    archive = zipfile.ZipFile(buff, mode='w', allowZip64=True)
+    for filename, data, digest in files:
+        archive.writestr(filename, data)
+        archive.filelist[-1].comment = digest
+    archive.close()
+    return buff.getvalue()
+
+
+def assemble(assembler, previous_bytes):
+    '''assemble - bytes of the zipfile of a ZipAssembler, the remote segments read from previous_bytes'''
+    data = []
+    for kind, offset, length in assembler.segments:
+        source = assembler.temp if kind == 'local' else StringIO(previous_bytes)
+        source.seek(offset)
+        data.append(source.read(length))
+    return ''.join(data)
+
+
+class TestPlanParts(unittest.TestCase):
+
+    def test_large_remote_ranges_are_copied(self):
+        parts = incremental.plan_parts([('local', 0, 100), ('remote', 0, 20 * MB), ('local', 100, 100)], 8 * MB)
+        # The local bytes before the range are topped up to the minimum part size from it
+        self.assertEqual(parts[0], ('upload', [('local', 0, 100), ('remote', 0, 5 * MB - 100)]))
+        self.assertEqual(parts[1], ('copy', 5 * MB - 100, 15 * MB + 100))
+        self.assertEqual(parts[2], ('upload', [('local', 100, 100)]))
+
+    def test_small_remote_ranges_are_uploaded(self):
+        parts = incremental.plan_parts([('local', 0, 100), ('remote', 0, 1 * MB), ('local', 100, 100)], 8 * MB)
+        self.assertEqual(parts, [('upload', [('local', 0, 100), ('remote', 0, 1 * MB), ('local', 100, 100)])])
+
+    def test_parts_respect_size_limits(self):
+        segments = [('local', 0, 3 * MB), ('remote', 0, 6 * MB), ('remote', 6 * MB, 11 * 1024 * MB),
+                    ('local', 3 * MB, 20 * MB)]
+        parts = incremental.plan_parts(segments, 8 * MB)
+        lengths = [part[2] if part[0] == 'copy' else sum(piece[2] for piece in part[1]) for part in parts]
+        self.assertEqual(sum(lengths), sum(segment[2] for segment in segments))
+        for length in lengths[:-1]:
+            self.assertTrue(incremental.MIN_PART_SIZE <= length <= incremental.MAX_PART_SIZE)
+
+
+class TestZipAssembler(unittest.TestCase):
+
+    def test_local_only(self):
+        assembler = incremental.ZipAssembler()
+        archive = zipfile.ZipFile(assembler, mode='w', allowZip64=True)
+        archive.writestr('metadata.txt', 'metadata')
+        archive.close()
+        self.assertFalse(assembler.has_remote)
+        self.assertEqual(zipfile.ZipFile(assembler.local_path()).read('metadata.txt'), 'metadata')
+
+    def test_reused_entries(self):
+        first, second = os.urandom(5000), os.urandom(7000)
+        previous_bytes = build_previous_zipfile([('metadata.txt', 'old', ''),
+                                                 ('first.csv', first, 'digest-1'),
+                                                 ('second.csv', 'old second', 'digest-2')])
+        previous = incremental.PreviousZipfile(None, 'previous.zip', 'etag', {})
+        previous.entries = dict((info.filename, info) for info in
+                                zipfile.ZipFile(StringIO(previous_bytes)).infolist() if info.comment)
+
+        def read_range(bucket, key, etag, offset, length):
+            return previous_bytes[offset:offset + length]
+
+        assembler = incremental.ZipAssembler()
+        archive = zipfile.ZipFile(assembler, mode='w', allowZip64=True)
+        archive.writestr('metadata.txt', 'new metadata')
+        with mock.patch.object(incremental, 'read_range', read_range):
+            incremental.add_reused_entry(archive, previous, previous.reusable('first.csv', 'digest-1'))
+        self.assertIsNone(previous.reusable('second.csv', 'digest-3'))
+        archive.writestr('second.csv', second)
+        archive.filelist[-1].comment = 'digest-3'
+        archive.close()
+
+        self.assertTrue(assembler.has_remote)
+        rebuilt = zipfile.ZipFile(StringIO(assemble(assembler, previous_bytes)))
+        self.assertIsNone(rebuilt.testzip())
+        self.assertEqual(rebuilt.read('metadata.txt'), 'new metadata')
+        self.assertEqual(rebuilt.read('first.csv'), first)
+        self.assertEqual(rebuilt.read('second.csv'), second)
+        self.assertEqual([info.comment for info in rebuilt.infolist()], ['', 'digest-1', 'digest-3'])
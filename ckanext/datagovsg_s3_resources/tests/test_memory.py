@@ -0,0 +1,129 @@
+'''
+Tests for the peak memory of the upload and zipfile paths
+
+They run against a moto S3 server started for the tests, in its own process so that
+the memory it holds is not measured. The bodies are synthetic and larger than the
+memory allowed, so a path holding a whole file in memory fails.
+'''
+import os
+import socket
+import subprocess
+import sys
+import time
+import unittest
+
+import ckanext.datagovsg_s3_resources.settings as settings
+import ckanext.datagovsg_s3_resources.upload as upload
+from ckanext.datagovsg_s3_resources.benchmark import SyntheticBody, measure_peak_memory
+
+MB = 1024 * 1024
+CHUNK_SIZE = 5 * MB
+CONCURRENCY = 2
+BODY_SIZE = 64 * MB
+# Chunks in flight, plus the interpreter's own growth while importing and connecting
+MAX_PEAK = (CONCURRENCY + 4) * CHUNK_SIZE
+
+
+def free_port():
+    '''free_port - a TCP port nothing listens on'''
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_moto_server(port):
+    '''start_moto_server - starts a moto S3 server on port, returns its process once it accepts connections'''
+    process = subprocess.Popen([sys.executable, '-m', 'moto.server', 's3', '-p', str(port)],
+                               stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return process
+        except socket.error:
+            time.sleep(0.1)
+    process.kill()
+    raise unittest.SkipTest('moto server did not start')
+
+
+class TestPeakMemory(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            import moto.server
+        except ImportError:
+            raise unittest.SkipTest('moto is not installed, see dev-requirements.txt')
+
+        port = free_port()
+        cls.server = start_moto_server(port)
+        endpoint_url = 'http://127.0.0.1:%d' % port
+        cls.previous_settings = settings._settings
+        settings.configure({
+            'ckan.datagovsg_s3_resources.s3_aws_access_key_id': 'testing',
+            'ckan.datagovsg_s3_resources.s3_aws_secret_access_key': 'testing',
+            'ckan.datagovsg_s3_resources.s3_aws_region_name': 'us-east-1',
+            'ckan.datagovsg_s3_resources.s3_bucket_name': 'memory-tests',
+            # Another host name than the endpoint's, so that presigned URLs are not taken for our bucket
+            'ckan.datagovsg_s3_resources.s3_url_prefix': 'http://localhost:%d/memory-tests/' % port,
+            'ckan.datagovsg_s3_resources.s3_endpoint_url': endpoint_url,
+            'ckan.datagovsg_s3_resources.s3_transfer_chunk_size': str(CHUNK_SIZE),
+            'ckan.datagovsg_s3_resources.s3_transfer_concurrency': str(CONCURRENCY),
+            'ckan.datagovsg_s3_resources.gzip_formats': 'csv',
+            'ckan.datagovsg_s3_resources.lock_backend': 'none',
+        })
+        cls.bucket = upload.setup_s3_bucket()
+        cls.bucket.create()
+        cls.source_key = 'source/source.csv'
+        cls.bucket.upload_fileobj(SyntheticBody(BODY_SIZE), cls.source_key, Config=upload.transfer_config())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.kill()
+        cls.server.wait()
+        settings._settings = cls.previous_settings
+
+    def source_resource(self):
+        '''source_resource - a resource whose file is the synthetic source in the bucket'''
+        return {
+            'id': 'memory-test',
+            'name': 'memory-test',
+            'package_id': 'memory-test',
+            'url': settings.get_settings().url_prefix + self.source_key,
+            'url_type': 's3',
+        }
+
+    def assert_peak_within_limit(self, func):
+        peak = measure_peak_memory(func)
+        self.assertLess(peak, MAX_PEAK, 'peak memory %.1f MB over %.1f MB' % (
+            peak / float(MB), MAX_PEAK / float(MB)))
+
+    def test_upload_resource_to_s3(self):
+        # Objects in our bucket are copied on the S3 side, so the source is read through a
+        # presigned URL to go through the streaming and gzip pipeline
+        presigned_url = self.bucket.meta.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket.name, 'Key': self.source_key})
+        resource = dict(self.source_resource(), url_type='', url=presigned_url)
+        self.assertEqual(upload.resource_format(resource), 'csv')
+
+        self.assert_peak_within_limit(
+            lambda: upload.upload_resource_to_s3({}, resource, {'name': 'memory-upload'}))
+
+        uploaded = [obj.key for obj in self.bucket.objects.filter(Prefix='memory-upload/')]
+        self.assertEqual(len(uploaded), 1)
+        head = self.bucket.meta.client.head_object(Bucket=self.bucket.name, Key=uploaded[0])
+        self.assertEqual(head.get('ContentEncoding'), 'gzip')
+
+    def test_upload_zipfile_to_s3(self):
+        key = 'memory-zip/memory-zip.zip'
+        entries = [('memory-test-%d.csv' % i, self.source_resource()) for i in range(2)]
+
+        self.assert_peak_within_limit(
+            lambda: upload.upload_zipfile_to_s3(key, 'metadata.txt', 'first build', entries))
+        # A metadata change rebuilds the zipfile incrementally
+        self.assert_peak_within_limit(
+            lambda: upload.upload_zipfile_to_s3(key, 'metadata.txt', 'second build', entries))
+
+        head = self.bucket.meta.client.head_object(Bucket=self.bucket.name, Key=key)
+        self.assertGreater(head['ContentLength'], 2 * BODY_SIZE)
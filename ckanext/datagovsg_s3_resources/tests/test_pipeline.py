@@ -0,0 +1,89 @@
+'''Tests for the streaming pipeline in pipeline.py'''
+import gzip
+import hashlib
+import unittest
+from StringIO import StringIO
+
+import ckanext.datagovsg_s3_resources.pipeline as pipeline
+
+
+class TrickleBody(object):
+    '''File-like body returning at most chunk_size bytes per read, like a socket'''
+    def __init__(self, data, chunk_size=1000):
+        self._fileobj = StringIO(data)
+        self._chunk_size = chunk_size
+        self.closed = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return self._fileobj.read()
+        return self._fileobj.read(min(size, self._chunk_size))
+
+    def close(self):
+        self.closed = True
+
+
+class TestResourceStream(unittest.TestCase):
+
+    def test_read_returns_requested_size(self):
+        # s3transfer chooses multipart from the length of a single read
+        data = 'a,b,c\n' * 100000
+        stream = pipeline.ResourceStream(TrickleBody(data))
+        self.assertEqual(len(stream.read(100000)), 100000)
+        self.assertEqual(len(stream.read(100)), 100)
+
+    def test_read_to_end(self):
+        data = 'a,b,c\n' * 100000
+        stream = pipeline.ResourceStream(TrickleBody(data))
+        self.assertEqual(stream.read(10) + stream.read(), data)
+        self.assertEqual(stream.read(10), '')
+
+    def test_digests_and_size(self):
+        data = 'a,b,c\n' * 100000
+        stream = pipeline.ResourceStream(TrickleBody(data))
+        while stream.read(65536):
+            pass
+        self.assertEqual(stream.md5, hashlib.md5(data).hexdigest())
+        self.assertEqual(stream.sha256, hashlib.sha256(data).hexdigest())
+        self.assertEqual(stream.size, len(data))
+
+    def test_body_shorter_than_sniff_size(self):
+        stream = pipeline.ResourceStream(TrickleBody('{"a": 1}'))
+        self.assertEqual(stream.sniffed_content_type, 'application/json')
+        self.assertEqual(stream.read(8192), '{"a": 1}')
+        self.assertEqual(stream.size, 8)
+
+    def test_sniff_content_type(self):
+        self.assertEqual(pipeline.sniff_content_type('%PDF-1.4'), ('application/pdf', '.pdf'))
+        self.assertEqual(pipeline.sniff_content_type('a,b,c\n1,2,3\n'), ('text/plain', '.txt'))
+        self.assertEqual(pipeline.sniff_content_type('\x00\x01\x02'), (None, None))
+
+    def test_close_closes_body(self):
+        body = TrickleBody('data')
+        pipeline.ResourceStream(body).close()
+        self.assertTrue(body.closed)
+
+
+class TestGzipStreams(unittest.TestCase):
+
+    def test_gzip_stream(self):
+        data = 'id,name,value\n' + '1,benchmark,12345.678\n' * 200000
+        stream = pipeline.GzipStream(StringIO(data))
+        compressed = ''.join(iter(lambda: stream.read(65536), ''))
+        self.assertTrue(len(compressed) < len(data) // 10)
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(compressed)).read(), data)
+
+    def test_gunzip_stream(self):
+        data = 'id,name,value\n' + '1,benchmark,12345.678\n' * 200000
+        buff = StringIO()
+        with gzip.GzipFile(fileobj=buff, mode='wb') as gzip_file:
+            gzip_file.write(data)
+        stream = pipeline.GunzipStream(TrickleBody(buff.getvalue()))
+        chunks = list(iter(lambda: stream.read(65536), ''))
+        self.assertEqual(''.join(chunks), data)
+        self.assertTrue(max(len(chunk) for chunk in chunks) <= 65536)
+
+    def test_round_trip(self):
+        data = 'x' * 3000000
+        stream = pipeline.GunzipStream(pipeline.GzipStream(TrickleBody(data)))
+        self.assertEqual(stream.read(), data)
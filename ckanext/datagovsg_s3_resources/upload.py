@@ -3,145 +3,555 @@ upload.py
 
 Contains functions that upload the resources/zipfiles to S3.
 
-Also contains the MetadataYAMLDumper class to generate the metadata for zipfiles.
+boto3, requests, slugify and yaml are imported where they are used, so that
+importing the plugins does not pay for them until S3 is actually touched.
 '''
 import cgi
 import os
-import StringIO
+import re
+import shutil
+import tempfile
 import zipfile
 import mimetypes
-import collections
 import logging
 import datetime
-from dateutil import parser
+import threading
+import urlparse
 
-from slugify import slugify
-from pylons import config
-import boto3
-import yaml
-import requests
-
-import paste.fileapp
 import ckan.plugins.toolkit as toolkit
 import ckan.lib.uploader as uploader
-from ckan.common import request
+
+import ckanext.datagovsg_s3_resources.incremental as incremental
+import ckanext.datagovsg_s3_resources.locks as locks
+import ckanext.datagovsg_s3_resources.manifest as manifest
+import ckanext.datagovsg_s3_resources.pipeline as pipeline
+from ckanext.datagovsg_s3_resources.settings import get_settings
+
+# Objects up to 5 GB are copied with a single CopyObject, larger ones with UploadPartCopy
+COPY_MULTIPART_THRESHOLD = 5 * 1024 * 1024 * 1024
+COPY_MULTIPART_CHUNKSIZE = 512 * 1024 * 1024
+
+# Timestamp and extension ending the key of a resource, see resource_s3_key
+TIMESTAMP_SUFFIX_RE = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}-\d{2}-\d{2}Z(\.[^/]*)?$')
+
+# Prefix of the keys of content-addressed blobs
+BLOB_PREFIX = 'blobs/'
+
+# Empty objects marking the blobs found unreferenced by s3_blob_gc, under the blob's key
+BLOB_GC_MARK_PREFIX = 'blob-gc-marks/'
+
+# Resource fields describing its S3 object, set by upload_resource_to_s3
+S3_OBJECT_FIELDS = ['url_type', 'hash', 'md5', 'size', 'mimetype']
+
+# Fields describing the contents of the S3 object, which only change with the object
+S3_DIGEST_FIELDS = ['hash', 'md5', 'size']
+
+# Key of the S3 object metadata holding the SHA-256 computed when the object was uploaded
+SHA256_METADATA_KEY = 'sha256'
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+# The S3 client is shared by all threads of a process, as boto3 clients are thread safe.
+# boto3 resources are not, so each thread gets its own Bucket over the shared client.
+_s3_shared = {}
+_s3_shared_lock = threading.Lock()
+_s3_local = threading.local()
+
+# Key of session.info holding the packages whose zipfile is uploaded after commit
+PENDING_PACKAGES_KEY = 'datagovsg_s3_resources_pending_packages'
+
+
+def s3_connection():
+    '''
+    s3_connection - The S3 client of the process and the class of S3 resources built over it
+
+    Created once per process and configuration, under a lock so that threads starting
+    together do not each build a boto3 session
+    '''
+    settings = get_settings()
+    with _s3_shared_lock:
+        # A client inherited through a fork must not be shared with the parent
+        if _s3_shared.get('pid') != os.getpid() or _s3_shared.get('settings') is not settings:
+            import boto3
+
+            session = boto3.session.Session(aws_access_key_id=settings.aws_access_key_id,
+                                            aws_secret_access_key=settings.aws_secret_access_key,
+                                            region_name=settings.aws_region_name)
+            s3 = session.resource('s3', endpoint_url=settings.endpoint_url)
+            _s3_shared.update(pid=os.getpid(), settings=settings,
+                              resource_class=s3.__class__, client=s3.meta.client)
+        return _s3_shared['resource_class'], _s3_shared['client']
 
 
 def setup_s3_bucket():
     '''
     setup_s3_bucket - Grabs the required info from config file and initializes S3 connection
-    '''
-    aws_access_key_id = config.get('ckan.datagovsg_s3_resources.s3_aws_access_key_id')
-    aws_secret_access_key = config.get('ckan.datagovsg_s3_resources.s3_aws_secret_access_key')
-    aws_region_name = config.get('ckan.datagovsg_s3_resources.s3_aws_region_name')
-    if aws_region_name:
-        s3 = boto3.resource('s3',
-                            aws_access_key_id=aws_access_key_id,
-                            aws_secret_access_key=aws_secret_access_key,
-                            region_name=aws_region_name)
-    else:
-        s3 = boto3.resource('s3',
-                            aws_access_key_id=aws_access_key_id,
-                            aws_secret_access_key=aws_secret_access_key)
 
-    bucket_name = config.get('ckan.datagovsg_s3_resources.s3_bucket_name')
-    bucket = s3.Bucket(bucket_name)
+    The Bucket is created once per thread over the client shared by the process, see s3_connection
+    '''
+    resource_class, client = s3_connection()
+    if getattr(_s3_local, 'client', None) is client:
+        return _s3_local.bucket
 
+    bucket = resource_class(client=client).Bucket(get_settings().bucket_name)
+    _s3_local.bucket = bucket
+    _s3_local.client = client
     return bucket
 
 
-def upload_resource_to_s3(context, resource):
+def transfer_config():
+    '''
+    transfer_config - Chunk size and concurrency of managed uploads and downloads
+
+    A transfer holds at most about concurrency * chunk size bytes in memory
+    '''
+    from boto3.s3.transfer import TransferConfig
+
+    settings = get_settings()
+    return TransferConfig(multipart_threshold=settings.transfer_chunk_size,
+                          multipart_chunksize=settings.transfer_chunk_size,
+                          max_concurrency=settings.transfer_concurrency)
+
+
+def warm_up():
+    '''
+    warm_up - Pre-creates the S3 connection so that the first upload does not pay for it
+
+    Registered to run after fork when ckan.datagovsg_s3_resources.warm_up_s3_client is set
+    '''
+    logger = logging.getLogger(__name__)
+    if get_settings().is_complete:
+        setup_s3_bucket()
+        logger.info("S3 connection warmed up in process %d" % os.getpid())
+
+
+def register_warm_up():
+    '''
+    register_warm_up - Runs warm_up in every worker after uWSGI forks it
+
+    Outside of uWSGI there is no fork to wait for, so the connection is warmed up immediately
+    '''
+    try:
+        import uwsgidecorators
+    except ImportError:
+        warm_up()
+    else:
+        uwsgidecorators.postfork(warm_up)
+
+
+def upload_resource_to_s3(context, resource, pkg=None, keep_digests=False):
     '''
     upload_resource_to_s3
 
+    pkg is the resource's package, fetched with package_show if not given.
+
+    keep_digests is set when the resource still points at the same object as before the
+    update, so that its 'hash' and 'md5' can be trusted and the object copied as is.
+
     Uploads resource to S3 and modifies the following resource fields:
     - 'upload'
     - 'url_type'
     - 'url'
+    - 'hash', 'md5', 'size' and 'mimetype', computed while the body is uploaded
+
+    The object is stored following the upload policy of the resource's format, see
+    resource_upload_args. The digests and size are always those of the uncompressed body.
+
+    Resources already in our bucket are copied to their new key on the S3 side if
+    keep_digests is set, see copy_resource_in_s3
     '''
 
     # Init logger
     logger = logging.getLogger(__name__)
     logger.info("Starting upload_resource_to_s3 for resource %s" % resource.get('name', ''))
 
+    # If the file is already in our bucket, it never needs to pass through CKAN
+    source_key = s3_key_for_url(resource.get('url', ''))
+    if (keep_digests and source_key is not None
+            and not isinstance(resource.get('upload', None), cgi.FieldStorage)):
+        if copy_resource_in_s3(context, resource, source_key, pkg):
+            return
+
     # Init connection to S3
     bucket = setup_s3_bucket()
 
-    # Get content type and extension
-    content_type, _ = mimetypes.guess_type(
-        resource.get('url', ''))
-    extension = mimetypes.guess_extension(content_type)
+    # Open the resource body. It is wrapped so that it is hashed, sniffed and counted
+    # while it is being uploaded
+    body = open_resource_body(resource)
+    timestamp = datetime.datetime.utcnow() # should match the assignment in the ResourceUpload class
 
-    # Upload to S3
-    pkg = toolkit.get_action('package_show')(context, {'id': resource['package_id']})
+    try:
+        stream = pipeline.ResourceStream(body)
+
+        # Get content type and extension
+        # Prefer the type given by the URL, fall back to the sniffed type
+        url_path = urlparse.urlparse(resource.get('url', '')).path
+        content_type, _ = mimetypes.guess_type(url_path)
+        extension = os.path.splitext(url_path)[1] if content_type else ''
+        if content_type is None:
+            content_type = stream.sniffed_content_type or 'application/octet-stream'
+            extension = stream.sniffed_extension or mimetypes.guess_extension(content_type) or ''
+
+        # Compress the body on the way if the format's policy asks for it
+        extra_args = resource_upload_args(resource, content_type, stream)
+        if extra_args.get('ContentEncoding') == 'gzip':
+            upload_body = pipeline.GzipStream(stream)
+        else:
+            upload_body = stream
+
+        # Upload to S3
+        logger.info("Uploading resource %s to S3" % resource.get('name', ''))
+        if get_settings().content_addressed_storage:
+            s3_filepath = upload_blob_to_s3(bucket, stream, upload_body, extension, extra_args)
+        else:
+            if pkg is None:
+                pkg = toolkit.get_action('package_show')(context, {'id': resource['package_id']})
+            s3_filepath = resource_s3_key(pkg, resource, timestamp, extension)
+            bucket.Object(s3_filepath).delete()
+            bucket.upload_fileobj(upload_body, s3_filepath,
+                                  ExtraArgs=extra_args,
+                                  Config=transfer_config())
+        logger.info("Successfully uploaded resource %s to S3" % resource.get('name', ''))
+
+    except Exception as exception:
+        # Log the error and reraise the exception
+        logger.error("Error uploading resource %s from package %s to S3" % (resource['name'], resource['package_id']))
+        logger.error(exception)
+        raise exception
+
+    finally:
+        # Uploaded files are left open, they belong to the request
+        if not isinstance(resource.get('upload', None), cgi.FieldStorage):
+            body.close()
+
+    # Modify fields in resource
+    resource['upload'] = ''
+    resource['url_type'] = 's3'
+    resource['url'] = get_settings().url_prefix + s3_filepath
+    resource['hash'] = stream.sha256
+    resource['md5'] = stream.md5
+    resource['size'] = stream.size
+    resource['mimetype'] = content_type
+    update_timestamp(resource, timestamp)
+
+
+def copy_resource_in_s3(context, resource, source_key, pkg=None):
+    '''
+    copy_resource_in_s3
+
+    Copies a resource already in our bucket to its new key with CopyObject, or with
+    multipart UploadPartCopy for objects over 5 GB, so that the data never passes
+    through CKAN. The content type, encoding and metadata of the object are carried
+    over, the cache headers follow the current upload policy, and the copy is made
+    public in the same request.
+
+    The resource's 'hash' and 'md5' are kept, so they must describe the object at
+    source_key, i.e. the URL must not have changed.
+
+    Modifies the resource fields like upload_resource_to_s3. Returns False if the
+    resource cannot be copied and has to be uploaded instead.
+    '''
+    from boto3.s3.transfer import TransferConfig
+    from botocore.exceptions import ClientError
+
+    logger = logging.getLogger(__name__)
+    bucket = setup_s3_bucket()
+    settings = get_settings()
+
+    try:
+        head = bucket.meta.client.head_object(Bucket=bucket.name, Key=source_key)
+    except ClientError as error:
+        logger.error("Error obtaining resource %s from S3 - %s" % (resource.get('name', ''), error))
+        toolkit.abort(404, toolkit._('Resource data not found'))
+    extension = os.path.splitext(source_key)[1]
     timestamp = datetime.datetime.utcnow() # should match the assignment in the ResourceUpload class
-    s3_filepath = (pkg.get('name')
-                   + '/'
-                   + 'resources'
-                   + '/'
-                   + slugify(resource.get('name'), to_lower=True)
-                   + '-'
-                   + timestamp.strftime("%Y-%m-%dT%H-%M-%SZ")
-                   + extension)
+
+    sha256 = object_sha256(head)
+    if settings.content_addressed_storage:
+        # Blobs never need to move
+        if source_key.startswith(BLOB_PREFIX):
+            target_key = source_key
+        # The blob key needs the SHA-256 of the contents. Only the one recorded when the
+        # object was uploaded is trusted, otherwise it is computed by uploading the object.
+        elif sha256 is None:
+            return False
+        else:
+            target_key = blob_key(sha256, extension)
+    else:
+        if pkg is None:
+            pkg = toolkit.get_action('package_show')(context, {'id': resource['package_id']})
+        target_key = resource_s3_key(pkg, resource, timestamp, extension)
+
+    content_type = (head.get('ContentType')
+                    or mimetypes.guess_type(source_key)[0]
+                    or 'application/octet-stream')
+
+    # An existing blob with the same contents is reused. s3_blob_gc keeps it, see commands.CleanupS3Blobs
+    if target_key != source_key and not (settings.content_addressed_storage
+                                         and s3_object_exists(bucket, target_key)):
+        extra_args = {
+            'ACL': 'public-read',
+            'ContentType': content_type,
+            'Metadata': head.get('Metadata', {}),
+            'MetadataDirective': 'REPLACE',
+        }
+        for field in ['CacheControl', 'ContentEncoding', 'ContentDisposition', 'Expires']:
+            if head.get(field):
+                extra_args[field] = head[field]
+        extra_args.update(cache_args(resource_format(resource)))
+        logger.info("Copying resource %s from %s to %s in S3" % (resource.get('name', ''), source_key, target_key))
+        bucket.copy({'Bucket': bucket.name, 'Key': source_key}, target_key,
+                     ExtraArgs=extra_args,
+                     Config=TransferConfig(multipart_threshold=COPY_MULTIPART_THRESHOLD,
+                                           multipart_chunksize=COPY_MULTIPART_CHUNKSIZE,
+                                           max_concurrency=settings.transfer_concurrency))
+        logger.info("Successfully copied resource %s in S3" % resource.get('name', ''))
+
+    # Modify fields in resource. The contents did not change, so the digests are kept
+    resource['upload'] = ''
+    resource['url_type'] = 's3'
+    resource['url'] = settings.url_prefix + target_key
+    if sha256 is not None:
+        resource['hash'] = sha256
+    # The length of a compressed object is not the size of the resource
+    if not head.get('ContentEncoding'):
+        resource['size'] = head.get('ContentLength', resource.get('size'))
+    resource['mimetype'] = content_type
+    update_timestamp(resource, timestamp)
+    return True
+
+
+def object_sha256(head):
+    '''object_sha256 - the SHA-256 recorded in the metadata of an S3 object when it was uploaded, or None'''
+    sha256 = head.get('Metadata', {}).get(SHA256_METADATA_KEY, '').lower()
+    return sha256 if SHA256_RE.match(sha256) else None
+
+
+def resource_s3_key(pkg, resource, timestamp, extension):
+    '''resource_s3_key - timestamped key of a resource, e.g. <pkg>/resources/<slug>-<timestamp><ext>'''
+    from slugify import slugify
+
+    return (pkg.get('name')
+            + '/'
+            + 'resources'
+            + '/'
+            + slugify(resource.get('name'), to_lower=True)
+            + '-'
+            + timestamp.strftime("%Y-%m-%dT%H-%M-%SZ")
+            + extension)
+
+
+def needs_new_s3_key(context, resource):
+    '''
+    needs_new_s3_key - True if the resource's S3 object is not under the key it would get now
+
+    e.g. after a rename that changes the slug, or once content-addressed storage is enabled.
+    With content-addressed storage, objects moved to their blob must have their SHA-256 recorded,
+    see copy_resource_in_s3. Older objects stay under their key rather than being streamed again
+    for a metadata-only update, until their file is uploaded again.
+    '''
+    from slugify import slugify
+    from botocore.exceptions import ClientError
+
+    key = s3_key_for_url(resource.get('url', ''))
+    if get_settings().content_addressed_storage:
+        if key.startswith(BLOB_PREFIX):
+            return False
+        bucket = setup_s3_bucket()
+        try:
+            head = bucket.meta.client.head_object(Bucket=bucket.name, Key=key)
+        except ClientError:
+            return False
+        return object_sha256(head) is not None
+
+    pkg = toolkit.get_action('package_show')(context, {'id': resource['package_id']})
+    prefix = (pkg.get('name')
+              + '/'
+              + 'resources'
+              + '/'
+              + slugify(resource.get('name'), to_lower=True)
+              + '-')
+    return not (key.startswith(prefix) and TIMESTAMP_SUFFIX_RE.match(key[len(prefix):]))
+
+
+def upload_blob_to_s3(bucket, stream, upload_body, extension, extra_args):
+    '''
+    upload_blob_to_s3
+
+    Uploads a resource body to the content-addressed key derived from its SHA-256 and
+    returns the key. upload_body, the stream or a compressed wrapper of it, is spooled
+    to a temporary file while the stream is hashed, and is not uploaded at all if a
+    blob with the same contents already exists.
+    '''
+    logger = logging.getLogger(__name__)
+    with tempfile.NamedTemporaryFile() as temp:
+        shutil.copyfileobj(upload_body, temp, pipeline.CHUNK_SIZE)
+        key = blob_key(stream.sha256, extension)
+        if s3_object_exists(bucket, key):
+            logger.info("Blob %s already exists, skipping upload" % key)
+            return key
+        temp.flush()
+        # Record the SHA-256, so that copies of the blob can be checked against it
+        extra_args = dict(extra_args, Metadata={SHA256_METADATA_KEY: stream.sha256})
+        # Uploaded by name: s3transfer reads the parts of an open file into memory ahead of the uploads
+        bucket.upload_file(temp.name, key, ExtraArgs=extra_args, Config=transfer_config())
+    return key
+
+
+def resource_upload_args(resource, content_type, stream):
+    '''
+    resource_upload_args - ExtraArgs of the upload of a resource object
+
+    Follows the upload policy of the resource's format:
+    - formats listed in gzip_formats are stored gzip compressed, with Content-Encoding: gzip,
+      unless the body is already compressed
+    - the cache headers of cache_args
+    The object is made public in the same request.
+    '''
+    settings = get_settings()
+    file_format = resource_format(resource)
+    extra_args = {'ACL': 'public-read', 'ContentType': content_type}
+    if (file_format in settings.gzip_formats
+            and stream.sniffed_content_type not in pipeline.COMPRESSED_CONTENT_TYPES):
+        extra_args['ContentEncoding'] = 'gzip'
+    extra_args.update(cache_args(file_format))
+    return extra_args
+
+
+def cache_args(file_format):
+    '''
+    cache_args - Cache-Control and Expires of a resource object of the given format
+
+    Resource keys are timestamped or content-addressed, so an object never changes
+    once uploaded and can be cached as immutable
+    '''
+    max_age = get_settings().cache_max_age_for(file_format)
+    if not max_age:
+        return {}
+    return {
+        'CacheControl': 'public, max-age=%d, immutable' % max_age,
+        'Expires': datetime.datetime.utcnow() + datetime.timedelta(seconds=max_age),
+    }
+
+
+def blob_key(sha256, extension):
+    '''blob_key - content-addressed key of a blob, e.g. blobs/ab/abcdef...0123.csv'''
+    return BLOB_PREFIX + sha256[:2] + '/' + sha256 + extension
+
+
+def s3_object_exists(bucket, key):
+    '''s3_object_exists - True if the key exists in the bucket'''
+    from botocore.exceptions import ClientError
+
+    try:
+        bucket.meta.client.head_object(Bucket=bucket.name, Key=key)
+    except ClientError as error:
+        if error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return True
+
+
+def is_metadata_only_update(current, resource):
+    '''
+    is_metadata_only_update - True if an update keeps the file already in our bucket
+
+    i.e. no new file is uploaded, and the URL is unchanged and points into our bucket
+    '''
+    return (not isinstance(resource.get('upload', None), cgi.FieldStorage)
+            and resource.get('url') == current.get('url')
+            and s3_key_for_url(current.get('url', '')) is not None)
+
+
+def keep_s3_object(current, resource):
+    '''
+    keep_s3_object - Keeps the existing S3 object for a metadata-only update
+
+    Destructively modifies resource, copying the fields describing the S3 object
+    from the current resource where the update does not give them. The digests and
+    size always come from the current resource, as the object does not change.
+    '''
+    resource['upload'] = ''
+    for field in S3_OBJECT_FIELDS:
+        if field in S3_DIGEST_FIELDS:
+            resource[field] = current.get(field)
+        elif resource.get(field) in (None, '') and current.get(field) not in (None, ''):
+            resource[field] = current[field]
+
+
+def open_resource_body(resource, session=None):
+    '''
+    open_resource_body
+
+    Opens the body of a resource for streaming, wherever it currently is:
+    - being uploaded, in resource['upload']
+    - on the CKAN file store
+    - in our S3 bucket, read with GetObject instead of through the public URL, and
+      decompressed if it is stored gzip compressed
+    - downloadable from resource['url']
+
+    The caller is responsible for closing the returned file object.
+    '''
+    import requests
+    from botocore.exceptions import ClientError
+
+    logger = logging.getLogger(__name__)
+    s3_key = s3_key_for_url(resource.get('url', ''))
 
     # If file is currently being uploaded, the file is in resource['upload']
     if isinstance(resource.get('upload', None), cgi.FieldStorage):
         logger.info("File is being uploaded")
         resource['upload'].file.seek(0)
-        body = resource['upload'].file
+        return resource['upload'].file
     # If resource.get('url_type') == 'upload' then the resource is in CKAN file system
     elif resource.get('url_type') == 'upload':
         logger.info("File is on CKAN file store")
         upload = uploader.ResourceUpload(resource)
         filepath = upload.get_path(resource['id'])
         try:
-            body = open(filepath, 'r')
-        except OSError:
-            abort(404, _('Resource data not found'))
+            return open(filepath, 'rb')
+        except (IOError, OSError):
+            toolkit.abort(404, toolkit._('Resource data not found'))
+    # If the URL points into our bucket, stream the object from S3 directly
+    elif s3_key is not None:
+        logger.info("File is in S3 bucket")
+        try:
+            s3_object = setup_s3_bucket().Object(s3_key).get()
+            if s3_object.get('ContentEncoding') == 'gzip':
+                return pipeline.GunzipStream(s3_object['Body'])
+            return s3_object['Body']
+        except ClientError as error:
+            logger.error("Error obtaining resource %s from S3 - %s" % (resource.get('name', ''), error))
+            toolkit.abort(404, toolkit._('Resource data not found'))
     else:
         logger.info("File is downloadable from URL")
         try:
             # Start session to download files
-            session = requests.Session()
+            if session is None:
+                session = requests.Session()
             logger.info("Attempting to obtain resource %s from url %s" % (resource.get('name',''), resource.get('url', '')))
             response = session.get(
-                resource.get('url', ''), timeout=30)
+                resource.get('url', ''), timeout=30, stream=True)
             # If the response status code is not 200 (i.e. success), raise Exception
             if response.status_code != 200:
+                response.close()
                 logger.error("Error obtaining resource from the given URL. Response status code is %d" % response.status_code)
                 raise Exception("Error obtaining resource from the given URL. Response status code is %d" % response.status_code)
-            body = response.content
             logger.info("Successfully obtained resource %s from url %s" % (resource.get('name',''), resource.get('url', '')))
+            # Undo any transfer encoding such as gzip while streaming
+            response.raw.decode_content = True
+            return response.raw
 
         except requests.exceptions.RequestException:
             toolkit.abort(404, toolkit._(
                 'Resource data not found'))
 
-    try:
-        logger.info("Uploading resource %s to S3" % resource.get('name', ''))
-        bucket.Object(s3_filepath).delete()
-        obj = bucket.put_object(Key=s3_filepath,
-                                Body=body,
-                                ContentType=content_type)
-        obj.Acl().put(ACL='public-read')
-        logger.info("Successfully uploaded resource %s to S3" % resource.get('name', ''))
 
-    except Exception as exception:
-        # Log the error and reraise the exception
-        logger.error("Error uploading resource %s from package %s to S3" % (resource['name'], resource['package_id']))
-        logger.error(exception)
-        if resource.get('url_type') == 'upload':
-            body.close()
-        raise exception
-
-    if resource.get('url_type') == 'upload':
-        body.close()
-
-    # Modify fields in resource
-    resource['upload'] = ''
-    resource['url_type'] = 's3'
-    resource['url'] = config.get('ckan.datagovsg_s3_resources.s3_url_prefix') + s3_filepath
-    update_timestamp(resource, timestamp)
+def s3_key_for_url(url):
+    '''s3_key_for_url - the key of the object in our bucket that url points to, or None'''
+    url_prefix = get_settings().url_prefix
+    if url_prefix and url and url.startswith(url_prefix) and len(url) > len(url_prefix):
+        return url[len(url_prefix):]
+    return None
 
 
 def upload_resource_zipfile_to_s3(context, resource):
@@ -157,92 +567,183 @@ def upload_resource_zipfile_to_s3(context, resource):
     if resource.get('format', '') == 'API':
         return
 
+    upload_zipfile_to_s3(*resource_zipfile_contents(context, resource))
+
+
+def ensure_resource_zipfile(context, resource):
+    '''
+    ensure_resource_zipfile
+
+    Used when resource zipfiles are built on demand. Builds the resource zipfile and
+    caches it in S3 if it is missing or out of date. Concurrent downloads of the same
+    resource wait for a single build.
+
+    Resources on external URLs cannot be checked without downloading them, so their
+    zipfile is only rebuilt once the metadata changes.
+    '''
+    logger = logging.getLogger(__name__)
+
+    # If resource is an API, there is no zipfile
+    if resource.get('format', '') == 'API':
+        return
+
+    contents = resource_zipfile_contents(context, resource)
+    key, _, metadata_text, entries = contents
+    new_manifest = manifest.build_manifest(metadata_text, entries)
+    bucket = setup_s3_bucket()
+    if manifest.is_current(bucket, key, new_manifest, allow_unknown=True):
+        return
+
+    lock = locks.get_lock('resource-' + resource['id'])
+    lock.acquire(blocking=True)
+    try:
+        # It may have been built while waiting for the lock
+        if not manifest.is_current(bucket, key, new_manifest, allow_unknown=True):
+            logger.info("Building resource zipfile on demand for resource %s" % resource.get('name', ''))
+            upload_zipfile_to_s3(*contents)
+    finally:
+        lock.release()
+
+
+def resource_zipfile_contents(context, resource):
+    '''
+    resource_zipfile_contents
+
+    Returns the (key, metadata filename, metadata text, entries) of the resource zipfile,
+    as taken by upload_zipfile_to_s3
+    '''
+    from slugify import slugify
+    from ckanext.datagovsg_s3_resources.metadata import metadata_yaml
+
     # Get resource's package
     pkg = toolkit.get_action('package_show')(context, {'id': resource['package_id']})
 
-    # Initialize resource zip file
-    resource_buff = StringIO.StringIO()
-    resource_zip_archive = zipfile.ZipFile(resource_buff, mode='w')
-
     # Initialize metadata
     metadata = toolkit.get_action(
         'package_metadata_show')(data_dict={'id': pkg['id']})
-    metadata_yaml_buff = StringIO.StringIO()
-    metadata_yaml_buff.write(unicode("# Metadata for %s\r\n" % pkg[
-                             "title"]).encode('ascii', 'ignore'))
-    yaml.dump(prettify_json(metadata),
-              metadata_yaml_buff, Dumper=MetadataYAMLDumper)
-
-    # Write metadata to package and updated resource zip
-    resource_zip_archive.writestr(
-        'metadata-' + pkg.get('name') + '.txt', metadata_yaml_buff.getvalue())
 
     # Obtain extension type of the resource
     resource_extension = os.path.splitext(resource['url'])[1]
     filename = (slugify(resource['name'], to_lower=True)
                 + resource_extension)
 
-    # Case 1: Resource is not on s3 yet, need to download from CKAN
-    if resource.get('url_type') == 'upload':
-        logger.info("Obtaining resource file from CKAN for resource %s" % resource.get('name', ''))
-        upload = uploader.ResourceUpload(resource)
-        filepath = upload.get_path(resource['id'])
-
-        resource_zip_archive.write(filepath, filename)
-
-    # Case 2: Resource exists outside of CKAN, we should have a URL to download it
-    else:
-        # Try to download the resource from the provided URL
-        try:
-            logger.info("Obtaining file from URL %s" % resource.get('url', ''))
-            session = requests.Session()
-            response = session.get(resource.get('url', ''), timeout=30)
-            # If the response status code is not 200 (i.e. success), raise Exception
-            if response.status_code != 200:
-                logger.error("Error obtaining resource from the given URL. Response status code is %d" % response.status_code)
-                raise Exception("Error obtaining resource from the given URL. Response status code is %d" % response.status_code)
-            logger.info("Successfully obtained file from URL %s" % resource.get('url', ''))
-        except requests.exceptions.RequestException:
-            toolkit.abort(404, toolkit._('Resource data not found'))
-
-        resource_zip_archive.writestr(filename, response.content)
-
-    # Initialize connection to S3
-    bucket = setup_s3_bucket()
-
-    # Upload the resource zip to S3
-    resource_zip_archive.close()
     resource_filename = (pkg.get('name')
                          + '/'
                          + 'resources'
                          + '/'
                          + slugify(resource.get('name'), to_lower=True)
                          + '.zip')
+    return (resource_filename,
+            'metadata-' + pkg.get('name') + '.txt',
+            metadata_yaml(pkg, metadata),
+            [(filename, resource)])
+
+
+def upload_package_zipfile_to_s3(context, pkg_dict):
+    '''
+    upload_zipfiles_to_s3
+
+    Uploads package zipfile to S3. Must be called after the changes to the package are
+    committed, see upload_package_zipfile_after_commit
+
+    Only one process builds the zipfile of a package at a time. Calls made while it is
+    being built elsewhere make that process build it again once it is done, see locks.py
+    '''
+    import ckan.model as model
+
+    def build():
+        '''build - builds the zipfile from the latest committed package'''
+        # The session may hold the package as it was before another process committed
+        # the changes that requested this build
+        model.Session.expire_all()
+        build_package_zipfile(context, pkg_dict)
+
+    lock = locks.get_lock('package-' + pkg_dict['id'])
+    locks.run_exclusively(lock, build)
+
+
+def upload_package_zipfile_after_commit(pkg_dict):
+    '''
+    upload_package_zipfile_after_commit
+
+    Uploads the package zipfile once the current transaction is committed, so that other
+    processes building it see the changes. Used from hooks that run before the commit,
+    e.g. package after_update. Nothing is uploaded if the transaction is rolled back.
+    '''
+    from sqlalchemy import event
+    import ckan.model as model
+
+    session = model.Session()
+    if PENDING_PACKAGES_KEY not in session.info:
+        event.listen(session, 'after_commit', _upload_pending_package_zipfiles)
+        event.listen(session, 'after_rollback', _discard_pending_package_zipfiles)
+    session.info.setdefault(PENDING_PACKAGES_KEY, set()).add(pkg_dict['id'])
+
+
+def _upload_pending_package_zipfiles(session):
+    '''
+    _upload_pending_package_zipfiles - after_commit listener of upload_package_zipfile_after_commit
+
+    A committed session cannot run queries from within the event, so each zipfile is built
+    in a thread of its own, with its own session, which is waited for
+    '''
+    package_ids = session.info.get(PENDING_PACKAGES_KEY, set())
+    session.info[PENDING_PACKAGES_KEY] = set()
+    for package_id in package_ids:
+        thread = threading.Thread(target=_upload_package_zipfile_in_thread, args=(package_id,))
+        thread.start()
+        thread.join()
+
+
+def _discard_pending_package_zipfiles(session):
+    '''_discard_pending_package_zipfiles - after_rollback listener of upload_package_zipfile_after_commit'''
+    session.info[PENDING_PACKAGES_KEY] = set()
+
+
+def _upload_package_zipfile_in_thread(package_id):
+    '''
+    _upload_package_zipfile_in_thread - uploads a package zipfile using the thread's own session
+
+    The thread serves no request and so has no user. The package is read ignoring
+    authorization, otherwise private packages would never get a zipfile.
+    '''
+    import ckan.model as model
+
+    logger = logging.getLogger(__name__)
     try:
-        logger.info("Uploading resource zipfile to S3 for resource %s" % resource.get('name', ''))
-        obj = bucket.put_object(
-            Key=resource_filename,
-            Body=resource_buff.getvalue(),
-            ContentType='application/zip'
-        )
-        # Set permissions of the S3 object to be readable by public
-        obj.Acl().put(ACL='public-read')
-        logger.info("Successfully uploaded resource zipfile to S3 for resource %s" % resource.get('name', ''))
+        upload_package_zipfile_to_s3({'ignore_auth': True}, {'id': package_id})
     except Exception as exception:
-        # Log the error and reraise the exception
-        logger.error("Error uploading resource %s zipfile to S3" % (resource['name']))
+        # The changes are already committed, there is nothing left to fail
+        logger.error("Error uploading package zipfile of package %s to S3" % package_id)
         logger.error(exception)
-        raise exception
+    finally:
+        model.Session.remove()
 
-def upload_package_zipfile_to_s3(context, pkg_dict):
+
+def build_package_zipfile(context, pkg_dict):
     '''
-    upload_zipfiles_to_s3
+    build_package_zipfile
 
-    Uploads package zipfile to S3
+    Builds the package zipfile and uploads it to S3. Use upload_package_zipfile_to_s3,
+    which makes sure that the package is not being built elsewhere
     '''
 
+    from slugify import slugify
+    import ckan.model as model
+    from ckanext.datagovsg_s3_resources.metadata import metadata_yaml
+
+    def show_context():
+        '''show_context - a fresh context for each show action, keeping the caller's user and authorization'''
+        show_context = {'model': model, 'session': model.Session,
+                        'ignore_auth': context.get('ignore_auth', False)}
+        # Without a user, the actions fall back to the user of the request
+        for key in ['user', 'auth_user_obj']:
+            if key in context:
+                show_context[key] = context[key]
+        return show_context
+
     # Obtain package
-    pkg = toolkit.get_action('package_show')(data_dict={'id': pkg_dict['id']})
+    pkg = toolkit.get_action('package_show')(show_context(), {'id': pkg_dict['id']})
 
     # Init logger
     logger = logging.getLogger(__name__)
@@ -255,83 +756,168 @@ def upload_package_zipfile_to_s3(context, pkg_dict):
 
     # Obtain package and package metadata
     metadata = toolkit.get_action(
-        'package_metadata_show')(data_dict={'id': pkg['id']})
+        'package_metadata_show')(show_context(), {'id': pkg['id']})
 
-    # Initialize package zip file
-    package_buff = StringIO.StringIO()
-    package_zip_archive = zipfile.ZipFile(package_buff, mode='w')
-
-    # Initialize metadata
-    metadata_yaml_buff = StringIO.StringIO()
-    metadata_yaml_buff.write(unicode("# Metadata for %s\r\n" % pkg[
-                             "title"]).encode('ascii', 'ignore'))
-    yaml.dump(prettify_json(metadata),
-              metadata_yaml_buff, Dumper=MetadataYAMLDumper)
-
-    # Write metadata to package and updated resource zip
-    package_zip_archive.writestr(
-        'metadata-' + pkg.get('name') + '.txt', metadata_yaml_buff.getvalue())
-
-    # Start session to make requests: for downloading files from S3
-    session = requests.Session()
-
-    # Iterate over resources, downloading and storing them in the package zip file
+    # List the resources to store in the package zip file, skipping APIs
+    entries = []
     for resource in pkg.get('resources'):
+        if resource.get('format') == 'API':
+            continue
         resource_extension = os.path.splitext(resource['url'])[1]
         filename = (slugify(resource['name'], to_lower=True)
                     + resource_extension)
+        entries.append((filename, resource))
+
+    # Upload package zip to S3
+    package_file_name = (pkg.get('name')
+                         + '/'
+                         + pkg.get('name')
+                         + '.zip')
+    upload_zipfile_to_s3(package_file_name,
+                         'metadata-' + pkg.get('name') + '.txt',
+                         metadata_yaml(pkg, metadata),
+                         entries)
 
-        # Case 1: Resource is API, skip it
-        if resource.get('format') == 'API':
-            continue
-        # Case 2: Resource is uploaded to CKAN server
-        elif resource.get('url_type') == 'upload':
-            logger.info("Obtaining resource file from CKAN for resource %s" % resource.get('name', ''))
-            upload = uploader.ResourceUpload(resource)
-            filepath = upload.get_path(resource['id'])
-            package_zip_archive.write(filepath, filename)
-
-        # Case 3: Resource is not on CKAN, should have a URL to download it from
-        else:
-            # Try to download the resource from the resource URL
-            try:
-                logger.info("Obtaining file from URL %s" % resource.get('url', ''))
-                response = session.get(resource.get('url', ''), timeout=30)
-                # If the response status code is not 200 (i.e. success), raise Exception
-                if response.status_code != 200:
-                    logger.error("Error obtaining resource from the given URL. Response status code is %d" % response.status_code)
-                    raise Exception("Error obtaining resource from the given URL. Response status code is %d" % response.status_code)
-                logger.info("Successfully obtained file from URL %s" % resource.get('url', ''))
-            except requests.exceptions.RequestException:
-                toolkit.abort(404, toolkit._('Resource data not found'))
 
-            package_zip_archive.writestr(filename, response.content)
+def upload_zipfile_to_s3(key, metadata_filename, metadata_text, entries):
+    '''
+    upload_zipfile_to_s3
 
+    Builds a zipfile holding the metadata and the resources in entries, a list of
+    (filename, resource), and uploads it to S3 under key.
+
+    The digest of a manifest of the metadata and of the entries' sources is stored with
+    the zipfile, see manifest.py. The zipfile is not rebuilt if nothing changed since the
+    last build. Otherwise the entries whose source did not change are copied from the
+    previous zipfile within S3, see incremental.py.
+    '''
+    from botocore.exceptions import ClientError
+
+    logger = logging.getLogger(__name__)
 
     # Initialize connection to S3
     bucket = setup_s3_bucket()
 
-    # Upload package zip to S3
-    package_zip_archive.close()
-    package_file_name = (pkg.get('name')
-                         + '/'
-                         + pkg.get('name')
-                         + '.zip')
+    new_manifest = manifest.build_manifest(metadata_text, entries)
+    if manifest.is_current(bucket, key, new_manifest):
+        logger.info("Zipfile %s is up to date, skipping rebuild" % key)
+        return
+
+    previous = incremental.PreviousZipfile.open(bucket, key)
     try:
-        logger.info("Uploading package zipfile to S3 for package %s" % pkg.get('name', ''))
-        obj = bucket.put_object(
-            Key=package_file_name,
-            Body=package_buff.getvalue(),
-            ContentType='application/zip'
-        )
-        # Set object permissions to public readable
-        obj.Acl().put(ACL='public-read')
-        logger.info("Successfully uploaded package zipfile to S3 for package %s" % pkg.get('name', ''))
-    except Exception as exception:
-        # Log the error and reraise the exception
-        logger.error("Error uploading package %s zip to S3" % (pkg['id']))
-        logger.error(exception)
-        raise exception
+        build_zipfile(bucket, key, metadata_filename, metadata_text, entries, new_manifest, previous)
+    except ClientError as error:
+        # The previous zipfile was replaced while its entries were being copied
+        if previous is None or error.response.get('Error', {}).get('Code') not in ('PreconditionFailed', '412'):
+            raise
+        logger.info("Zipfile %s changed during the rebuild, rebuilding it in full" % key)
+        build_zipfile(bucket, key, metadata_filename, metadata_text, entries, new_manifest, None)
+
+
+def build_zipfile(bucket, key, metadata_filename, metadata_text, entries, new_manifest, previous):
+    '''
+    build_zipfile - Builds and uploads the zipfile of upload_zipfile_to_s3
+
+    Entries of previous, the PreviousZipfile or None, built from the same sources are reused.
+    Every entry written records the digest of its source as its comment, so that the next
+    build can reuse it.
+    '''
+    import requests
+
+    logger = logging.getLogger(__name__)
+
+    # Initialize zip file. It is built on disk so that it is never held in memory
+    zip_buff = incremental.ZipAssembler()
+    zip_archive = zipfile.ZipFile(zip_buff, mode='w', allowZip64=True)
+    try:
+        # Write metadata to zip
+        zip_archive.writestr(metadata_filename, metadata_text)
+
+        # Start session to make requests: for downloading files
+        session = requests.Session()
+
+        for filename, resource in entries:
+            digest = new_manifest['entries'].get(filename)
+            reused = previous.reusable(filename, digest) if previous is not None else None
+            # Case 0: Resource did not change since the previous zipfile, copy it within S3
+            if reused is not None:
+                logger.info("Reusing resource file of the previous zipfile for resource %s" % resource.get('name', ''))
+                incremental.add_reused_entry(zip_archive, previous, reused)
+                continue
+            # Case 1: Resource is uploaded to CKAN server
+            if resource.get('url_type') == 'upload':
+                logger.info("Obtaining resource file from CKAN for resource %s" % resource.get('name', ''))
+                upload = uploader.ResourceUpload(resource)
+                filepath = upload.get_path(resource['id'])
+                zip_archive.write(filepath, filename)
+            # Case 2: Resource is in our bucket, download it from S3 directly
+            elif s3_key_for_url(resource.get('url', '')) is not None:
+                logger.info("Obtaining resource file from S3 for resource %s" % resource.get('name', ''))
+                write_zip_s3_object(zip_archive, bucket, s3_key_for_url(resource['url']), filename)
+            # Case 3: Resource is not on CKAN, should have a URL to download it from
+            else:
+                write_zip_stream(zip_archive, open_resource_body(resource, session), filename)
+            zip_archive.filelist[-1].comment = digest or ''
+
+        zip_archive.close()
+
+        extra_args = {
+            'ACL': 'public-read',
+            'ContentType': 'application/zip',
+            'Metadata': {manifest.MANIFEST_DIGEST_KEY: manifest.manifest_digest(new_manifest)},
+        }
+        try:
+            logger.info("Uploading zipfile %s to S3" % key)
+            # The zipfile is made public readable in the same request
+            if zip_buff.has_remote:
+                incremental.upload_assembled(bucket, key, zip_buff, previous, extra_args,
+                                             get_settings().transfer_chunk_size)
+            else:
+                # Uploaded by name: s3transfer reads the parts of an open file into memory ahead of the uploads
+                bucket.upload_file(zip_buff.local_path(), key, ExtraArgs=extra_args, Config=transfer_config())
+            logger.info("Successfully uploaded zipfile %s to S3" % key)
+        except Exception as exception:
+            # Log the error and reraise the exception
+            logger.error("Error uploading zipfile %s to S3" % key)
+            logger.error(exception)
+            raise exception
+    finally:
+        zip_buff.close()
+
+
+def write_zip_s3_object(zip_archive, bucket, key, filename):
+    '''
+    write_zip_s3_object - Writes an object of our bucket into the zipfile
+
+    Large objects are downloaded with parallel ranged GetObject requests into a temporary file.
+    Objects stored gzip compressed are streamed and decompressed instead.
+    '''
+    head = bucket.meta.client.head_object(Bucket=bucket.name, Key=key)
+    if head.get('ContentEncoding') == 'gzip':
+        body = bucket.Object(key).get()['Body']
+        write_zip_stream(zip_archive, pipeline.GunzipStream(body), filename)
+        return
+
+    with tempfile.NamedTemporaryFile() as temp:
+        bucket.download_fileobj(key, temp, Config=transfer_config())
+        temp.flush()
+        zip_archive.write(temp.name, filename)
+
+
+def write_zip_stream(zip_archive, fileobj, filename):
+    '''
+    write_zip_stream - Writes a stream into the zipfile and closes it
+
+    The stream is spooled through a temporary file, so that it is never held in memory
+    '''
+    try:
+        with tempfile.NamedTemporaryFile() as temp:
+            shutil.copyfileobj(fileobj, temp, pipeline.CHUNK_SIZE)
+            temp.flush()
+            zip_archive.write(temp.name, filename)
+    finally:
+        fileobj.close()
+
 
 def resources_all_api(resources):
     for resource in resources:
@@ -341,14 +927,17 @@ def resources_all_api(resources):
 
 def is_blacklisted(resource):
     '''is_blacklisted - Check if the resource type is blacklisted'''
-    blacklist = config.get('ckan.datagovsg_s3_resources.upload_filetype_blacklist', '').split()
-    blacklist = [t.lower() for t in blacklist]
-    resource_format = resource.get('format', '').lower()
-    # If resource is being created, format will still be empty. Use file extension instead
-    if resource_format == '':
-        _, file_ext = os.path.splitext(resource.get('url'))
-        resource_format = file_ext[1:].lower()
-    return resource_format in blacklist
+    return resource_format(resource) in get_settings().upload_filetype_blacklist
+
+def resource_format(resource):
+    '''resource_format - lowercase format of the resource, e.g. csv'''
+    file_format = (resource.get('format') or '').lower()
+    # If resource is being created, format will still be empty. Use file extension instead,
+    # ignoring the query string, e.g. of a presigned URL
+    if file_format == '':
+        _, file_ext = os.path.splitext(urlparse.urlparse(resource.get('url') or '').path)
+        file_format = file_ext[1:].lower()
+    return file_format
 
 def update_timestamp(resource, timestamp):
     '''use the last modified time if it exists, otherwise use the created time.
@@ -360,79 +949,8 @@ def update_timestamp(resource, timestamp):
         resource['last_modified'] = timestamp
 
 
-class MetadataYAMLDumper(yaml.SafeDumper):
-    '''
-    class MetadataYAMLDumper
-
-    Used to generate metadata for the CKAN resources/packages
-    '''
-    def __init__(self, *args, **kws):
-        kws['default_flow_style'] = False
-        kws['explicit_start'] = True
-        kws['line_break'] = '\r\n'
-
-        super(MetadataYAMLDumper, self).__init__(*args, **kws)
-
-    def expect_block_sequence(self):
-        '''expect_block_sequence - add the first indentation for list'''
-        self.increase_indent(flow=False, indentless=False)
-        self.state = self.expect_first_block_sequence_item
-
-    def expect_block_sequence_item(self, first=False):
-        '''expect_block_sequence_item - modify this to add extra line breaks'''
-        if not first and isinstance(self.event, yaml.SequenceEndEvent):
-            self.indent = self.indents.pop()
-            self.state = self.states.pop()
-        else:
-            self.write_indent()
-            self.write_indicator(u'-', True, indention=True)
-            # add a line break for sequence items which have mapping type
-            if isinstance(self.event, yaml.MappingStartEvent):
-                self.write_line_break()
-            self.states.append(self.expect_block_sequence_item)
-            self.expect_node(sequence=True)
-
-    def represent_odict(self, data):
-        '''represent_odict - represent OrderedDict'''
-        value = list()
-        node = yaml.nodes.MappingNode(
-            'tag:yaml.org,2002:map', value, flow_style=None)
-        if self.alias_key is not None:
-            self.represented_objects[self.alias_key] = node
-        for item_key, item_value in data.items():
-            node_key = self.represent_data(item_key)
-            node_value = self.represent_data(item_value)
-            value.append((node_key, node_value))
-        node.flow_style = False
-        return node
-
-    def choose_scalar_style(self):
-        '''choose_scalar_style - single quotes'''
-        is_dict_key = self.states[-1] == self.expect_block_mapping_simple_value
-        if is_dict_key:
-            return None
-        return "'"
-
-MetadataYAMLDumper.add_representer(
-    collections.OrderedDict, MetadataYAMLDumper.represent_odict)
-
-
 # Helper functions
 
-def prettify_json(json):
-    '''prettify_json - removes leading and trailing whitespace'''
-    if isinstance(json, dict):
-        for key in json.keys():
-            prettified_name = key.replace('_', ' ').title()
-            json[prettified_name] = prettify_json(json.pop(key))
-    elif isinstance(json, list):
-        return [prettify_json(obj) for obj in json]
-    elif isinstance(json, basestring):
-        # remove leading and trailing white spaces, new lines, tabs
-        json = json.strip(' \t\n\r')
-    return json
-
-
 def is_downloadable_url(url):
     '''is_downloadable_url - check if url is downloadable'''
     content_type, _ = mimetypes.guess_type(url)
@@ -443,12 +961,4 @@ def is_downloadable_url(url):
 
 def config_exists():
     '''config_exists - checks for the required s3 config options'''
-    access_key = config.get('ckan.datagovsg_s3_resources.s3_aws_access_key_id')
-    secret_key = config.get('ckan.datagovsg_s3_resources.s3_aws_secret_access_key')
-    bucket_name = config.get('ckan.datagovsg_s3_resources.s3_bucket_name')
-    url = config.get('ckan.datagovsg_s3_resources.s3_url_prefix')
-
-    return not (access_key is None or
-                secret_key is None or
-                bucket_name is None or
-                url is None)
+    return get_settings().is_complete
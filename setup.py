@@ -77,5 +77,7 @@ setup(
         datagovsg_s3_resources_package=ckanext.datagovsg_s3_resources.package_plugin:DatagovsgS3ResourcesPackagePlugin
         [paste.paster_command]
         migrate_s3 = ckanext.datagovsg_s3_resources.commands:MigrateToS3
+        s3_blob_gc = ckanext.datagovsg_s3_resources.commands:CleanupS3Blobs
+        s3_benchmark = ckanext.datagovsg_s3_resources.benchmark:S3Benchmark
     ''',
 )